@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+# Description: times simplification and rendering on the bundled NYC data and on synthetic
+#   lines of 10^3 to 10^6 vertices, writes the results as json and compares them to a stored
+#   baseline; exits with an error if any stage got slower than the baseline allows. Also
+#   measures how far Douglas-Peucker and Visvalingam-Whyatt move the subway lines
+# Example usage:
+#   python benchmark.py
+#   python benchmark.py -ms 100000 -n 1
+#   python benchmark.py -sb
+
+import argparse
+import json
+import numpy as np
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from polysimplify import DPBatchSimplifier, DPSimplifier, VWBatchSimplifier, VWSimplifier, WKTSimplifier, check_thresholds, fancy_parametric, parse_wkt_points
+from spatialindex import metricPoints, pointSegmentDistances
+
+# input
+parser = argparse.ArgumentParser()
+parser.add_argument('-of', dest="OUTPUT_FILE", default="benchmark_results.json", help="Path to output json file of results")
+parser.add_argument('-bf', dest="BASELINE_FILE", default="benchmark_baseline.json", help="Path to json file of baseline results to compare against")
+parser.add_argument('-sb', dest="SAVE_BASELINE", action="store_true", help="Save the results as the new baseline instead of comparing against it")
+parser.add_argument('-n', dest="REPEATS", default="3", type=int, help="Number of times each stage is run; the fastest run counts")
+parser.add_argument('-ms', dest="MAX_SIZE", default="1000000", type=int, help="Largest synthetic line in the scaling curves, in vertices")
+parser.add_argument('-st', dest="SLOWER_THRESHOLD", default="1.5", type=float, help="Fail if a stage takes more than this many times its baseline")
+parser.add_argument('-mt', dest="MIN_TIME", default="0.01", type=float, help="Seconds a stage must slow down by before it counts as slower")
+parser.add_argument('-w', dest="WIDTHS", default="500,2000,8000", help="Comma-separated widths to render")
+parser.add_argument('-wv', dest="WKT_VERTICES", default="300000", type=int, help="Vertices in the multipolygon written to and read from WKT")
+parser.add_argument('-qr', dest="QUALITY_RATIOS", default="0.05,0.1,0.2", help="Comma-separated ratios of points kept at which to compare Douglas-Peucker and Visvalingam-Whyatt")
+
+# init input
+args = parser.parse_args()
+WIDTHS = [int(width) for width in args.WIDTHS.split(',')]
+QUALITY_RATIOS = [float(ratio) for ratio in args.QUALITY_RATIOS.split(',')]
+
+# name => {"seconds" (fastest), "median", "runs", "vertices"}
+results = {}
+# name => {"maxMeters", "meanMeters", "vertices"}, not compared to the baseline
+quality = {}
+
+def run(name, fn, vertices=None, repeats=None):
+    times = []
+    for i in range(repeats or args.REPEATS):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    results[name] = {
+        "seconds": min(times),
+        "median": float(np.median(times)),
+        "runs": len(times),
+        "vertices": vertices
+    }
+    print "%-40s %10.4fs" % (name, min(times))
+
+# a closed-form curve of n vertices, the same on every run
+def parametricLine(n):
+    thetas = np.linspace(0, 16*np.pi, n)
+    (xt, yt) = fancy_parametric(1.4)
+    return np.column_stack((xt(thetas), yt(thetas)))
+
+# every line of a geojson file back to back, with offsets
+def readLines(filename):
+    from featurestore import ParsedLayer
+    parsed = ParsedLayer(filename)
+    return (parsed.coords, np.concatenate(([0], np.cumsum(parsed.lengths))))
+
+# distance from every point of lines back to back (split at offsets) to the line through the
+#   points kept by mask and the ends of every line
+def deviations(pts, offsets, mask):
+    lengths = np.diff(offsets)
+    kept = mask.copy()
+    kept[offsets[:-1][lengths > 0]] = True
+    kept[offsets[1:][lengths > 0] - 1] = True
+    # the kept points on either side of every point; a kept point is its own segment
+    indices = np.arange(len(pts))
+    before = np.maximum.accumulate(np.where(kept, indices, 0))
+    after = np.minimum.accumulate(np.where(kept, indices, len(pts) - 1)[::-1])[::-1]
+    return pointSegmentDistances(pts, pts[before], pts[after])[0]
+
+# Heap thresholds against the quadratic reference, before timing them: the curve, the subway
+#   lines, and small lines on a grid, whose equal areas test how ties are broken
+(pts, offsets) = readLines("data/nycsubway.geojson")
+rng = np.random.RandomState(0)
+checkLines = [parametricLine(5000)] + [pts[a:b] for (a, b) in zip(offsets[:-1], offsets[1:])]
+checkLines += [rng.randint(0, 4, (n, 2)).astype(float) for n in [2, 3, 4, 5, 8, 20, 50, 200] for i in range(5)]
+mismatches = check_thresholds(checkLines)
+if mismatches:
+    print "Heap thresholds differ from the reference on %s of %s lines: %s" % (len(mismatches), len(checkLines), mismatches)
+    sys.exit(1)
+print "Heap thresholds match the reference on %s lines" % len(checkLines)
+
+# Scaling curves
+size = 1000
+while size <= args.MAX_SIZE:
+    pts = parametricLine(size)
+    # the largest lines take a while, so they are run once
+    repeats = 1 if size >= 1000000 else None
+    run("vw_build_%s" % size, lambda: VWSimplifier(pts), size, repeats)
+    simplifier = VWSimplifier(pts)
+    run("vw_from_number_%s" % size, lambda: simplifier.from_number(size // 10), size)
+    run("vw_from_ratio_%s" % size, lambda: simplifier.from_ratio(0.1), size)
+    # compact simplifiers select with np.partition on every call instead of keeping a sorted copy
+    compact = VWSimplifier(pts, compact=True, dtype=np.float32)
+    run("vw_compact_from_number_%s" % size, lambda: compact.from_number(size // 10), size)
+    run("dp_build_%s" % size, lambda: DPSimplifier(pts), size, repeats)
+    size *= 10
+
+# WKT of a multipolygon, as fed to PostGIS; rings are built outside the timings
+polygons = 100
+ring = parametricLine(args.WKT_VERTICES // (2 * polygons) - 1)
+ring = np.vstack((ring, ring[:1]))
+simplifiers = [[WKTSimplifier(ring + 10 * i), WKTSimplifier(ring * 0.5 + 10 * i)] for i in range(polygons)]
+wktVertices = 2 * polygons * len(ring)
+multi2wkt = lambda precision: 'MULTIPOLYGON (%s)' % ','.join(['(%s)' % ','.join([simplifier.wkt_from_threshold(0, precision) for simplifier in polygon]) for polygon in simplifiers])
+# sizes are in the names, as a baseline taken at another -wv can't be compared
+for precision in [None, 6]:
+    name = "wkt_format_multipolygon" + ("_p%s" % precision if precision else "") + "_%s" % args.WKT_VERTICES
+    run(name, lambda: multi2wkt(precision), wktVertices)
+    print "%-40s %10.0f vertices/s" % ("", wktVertices / results[name]["seconds"])
+    for polygon in simplifiers:
+        for simplifier in polygon:
+            simplifier.set_precision(None)
+wkt = multi2wkt(None)
+name = "wkt_parse_multipolygon_%s" % args.WKT_VERTICES
+run(name, lambda: parse_wkt_points(wkt.split(' ', 1)[1]), wktVertices)
+print "%-40s %10.0f vertices/s" % ("", wktVertices / results[name]["seconds"])
+
+# Simplification of the bundled data
+for (name, filename) in [("subway", "data/nycsubway.geojson"), ("boroughs", "data/nycboroughs.geojson")]:
+    (pts, offsets) = readLines(filename)
+    run("vw_batch_build_%s" % name, lambda: VWBatchSimplifier(pts, offsets), len(pts))
+    batch = VWBatchSimplifier(pts, offsets)
+    run("vw_batch_from_ratio_%s" % name, lambda: batch.mask_from_ratio(0.1), len(pts))
+    outputDir = tempfile.mkdtemp()
+    try:
+        command = [sys.executable, "simplifygeojson.py", "-if", filename, "-of", os.path.join(outputDir, "%s_%%s.geojson" % name), "-r", "0.1"]
+        run("simplifygeojson_%s" % name, lambda: subprocess.check_call(command, stdout=open(os.devnull, 'w')), len(pts))
+    finally:
+        shutil.rmtree(outputDir)
+
+# Douglas-Peucker against Visvalingam-Whyatt on the subway lines, kept to the same numbers of points
+(pts, offsets) = readLines("data/nycsubway.geojson")
+pts = metricPoints(pts, offsets)
+run("dp_batch_build_subway", lambda: DPBatchSimplifier(pts, offsets), len(pts))
+batches = [("vw", VWBatchSimplifier(pts, offsets)), ("dp", DPBatchSimplifier(pts, offsets))]
+print "%-40s %10s %10s %10s" % ("subway lines", "points", "max m", "mean m")
+for ratio in QUALITY_RATIOS:
+    for (algorithm, batch) in batches:
+        mask = batch.mask_from_ratio(ratio)
+        d = deviations(pts, offsets, mask)
+        name = "%s_quality_subway_%s" % (algorithm, ratio)
+        quality[name] = {"maxMeters": float(d.max()), "meanMeters": float(d.mean()), "vertices": int(mask.sum())}
+        print "%-40s %10d %10.2f %10.2f" % (name, mask.sum(), d.max(), d.mean())
+
+# Rendering of config.json; cold renders parse every file, warm ones reuse a renderer's cache
+from geojson2svg import Renderer
+outputDir = tempfile.mkdtemp()
+try:
+    filename = os.path.join(outputDir, "nyc.svg")
+    for width in WIDTHS:
+        run("render_cold_%s" % width, lambda: Renderer().render("config.json", filename, width, verbose=False))
+        renderer = Renderer()
+        renderer.render("config.json", filename, width, verbose=False)
+        run("render_warm_%s" % width, lambda: renderer.render("config.json", filename, width, verbose=False))
+        # a new process redrawing nothing but copying every layer from the fragment directory
+        fragmentDir = os.path.join(outputDir, "fragments")
+        Renderer().render("config.json", filename, width, verbose=False, fragmentDir=fragmentDir)
+        run("render_fragments_%s" % width, lambda: Renderer().render("config.json", filename, width, verbose=False, fragmentDir=fragmentDir))
+    # every width as a variant of one batch, reading and grouping the layers once
+    variants = [{"file": os.path.join(outputDir, "nyc_%s.svg" % width), "width": width} for width in WIDTHS]
+    run("render_variants_%s" % len(WIDTHS), lambda: Renderer().renderVariants("config.json", variants, verbose=False))
+finally:
+    shutil.rmtree(outputDir)
+
+report = {
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "platform": platform.platform(),
+    "results": results,
+    "quality": quality
+}
+with open(args.OUTPUT_FILE, 'w') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+print "Saved results to %s" % args.OUTPUT_FILE
+
+if args.SAVE_BASELINE:
+    with open(args.BASELINE_FILE, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "Saved baseline to %s" % args.BASELINE_FILE
+    sys.exit(0)
+
+if not os.path.isfile(args.BASELINE_FILE):
+    print "No baseline at %s to compare against; run with -sb to save one" % args.BASELINE_FILE
+    sys.exit(0)
+
+# Compare against the baseline
+with open(args.BASELINE_FILE) as f:
+    baseline = json.load(f)["results"]
+slower = []
+# stages added since the baseline was saved
+missing = []
+for name in sorted(results):
+    if name not in baseline:
+        missing.append(name)
+        print "%-40s %10s %10.4fs %8s  NO BASELINE" % (name, "-", results[name]["seconds"], "-")
+        continue
+    (seconds, baseSeconds) = (results[name]["seconds"], baseline[name]["seconds"])
+    ratio = seconds / max(baseSeconds, 1e-9)
+    isSlower = ratio > args.SLOWER_THRESHOLD and seconds - baseSeconds > args.MIN_TIME
+    if isSlower:
+        slower.append(name)
+    print "%-40s %10.4fs %10.4fs %7.2fx%s" % (name, baseSeconds, seconds, ratio, "  SLOWER" if isSlower else "")
+# baseline stages this run left out, such as larger sizes than -ms
+notRun = sorted(set(baseline) - set(results))
+for name in notRun:
+    print "%-40s %10.4fs %10s %8s  NOT RUN" % (name, baseline[name]["seconds"], "-", "-")
+if missing:
+    print "%s of %s stages have no baseline and were not compared; run with -sb to save one: %s" % (len(missing), len(results), ', '.join(missing))
+if notRun:
+    print "%s of %s baseline stages were not run and were not compared: %s" % (len(notRun), len(baseline), ', '.join(notRun))
+if slower:
+    print "%s of %s stages are slower than the baseline: %s" % (len(slower), len(results), ', '.join(slower))
+    sys.exit(1)
+print "No stage is slower than the baseline"
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+# Description: columnar store for the paths drawn by geojson2svg.py; every path's
+#   coordinates live in one float64 buffer, and its layer, group, style and label
+#   are small integer codes into shared tables. Geojson files are parsed into
+#   ParsedLayers (or CachedLayers, from a binary copy of the file), which can be kept
+#   in a LayerCache and restyled without re-reading. A finished store can be shared
+#   with worker processes, its arrays in shared memory rather than pickled.
+# Example usage:
+#   parsed = ParsedLayer("data/nycsubway_simplified_0.1.geojson")
+#   store = FeatureStore()
+#   layer = store.addLayer("routes")
+#   groups = [store.group(p["route_id"], layer, p["route_id"]) for p in parsed.properties]
+#   ...
+#   store.addPaths(parsed.coords, parsed.lengths, groups[parsed.pathFeatures], styles[...], labels[...])
+#   store.finish()
+#   shared = store.share()   # passed to workers as a Pool initializer argument
+#   store = sharedStore(shared)
+
+from array import array
+from collections import OrderedDict
+import copy
+import csv
+import ctypes
+from geojsonstream import FeatureReader, filterByThreshold
+from geometrycache import openGeometry
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+import sys
+
+# rows measured to estimate the memory of properties
+SIZE_SAMPLE = 1000
+
+def getPathsRecursive(arr):
+    # this is a line
+    if isPath(arr):
+        return arr
+
+    # this is an array of lines
+    elif isinstance(arr[0], list):
+        results = []
+        for subArr in arr:
+            result = getPathsRecursive(subArr)
+            if isPath(result):
+                results.append(result)
+            else:
+                results += result
+        return results
+
+
+def isPath(arr):
+    return isinstance(arr[0], list) and isinstance(arr[0][0], float)
+
+# estimated bytes python holds for a list of values, such as property dicts (with their keys and
+#   values) or a column; an even sample of them is measured and scaled to all. Keys are counted
+#   once per object, as csv rows share theirs, and only scaled if the sample doesn't share them
+def valuesBytes(values):
+    if not values:
+        return sys.getsizeof(values)
+    sample = values[::max(len(values) // SIZE_SAMPLE, 1)]
+    (sampleBytes, keyBytes, keys) = (0, 0, {})
+    for value in sample:
+        sampleBytes += sys.getsizeof(value)
+        if isinstance(value, dict):
+            for (k, v) in value.items():
+                sampleBytes += sys.getsizeof(v)
+                if id(k) not in keys:
+                    keys[id(k)] = k
+                    keyBytes += sys.getsizeof(k)
+    if isinstance(sample[0], dict) and len(keys) > len(sample[0]):
+        sampleBytes += keyBytes
+        keyBytes = 0
+    return sys.getsizeof(values) + keyBytes + sampleBytes * len(values) // len(sample)
+
+class ParsedLayer(object):
+
+    # read every path of a geojson file; threshold picks a level of detail from a progressive file
+    def __init__(self, filename, threshold=None):
+        self.filename = filename
+        # properties of every feature, and for every path the feature it belongs to
+        self.properties = []
+        buf = array('d')
+        lengths = array('l')
+        pathFeatures = array('l')
+        with open(filename) as f:
+            for feature in FeatureReader(f):
+                coordinates = feature['geometry']['coordinates']
+                if threshold is not None and 'thresholds' in feature['geometry']:
+                    coordinates = filterByThreshold(coordinates, feature['geometry']['thresholds'], threshold)
+                for path in getPathsRecursive(coordinates):
+                    for lnglat in path:
+                        buf.append(lnglat[0])
+                        buf.append(lnglat[1])
+                    lengths.append(len(path))
+                    pathFeatures.append(len(self.properties))
+                self.properties.append(feature['properties'])
+        self.coords = np.frombuffer(buf, dtype=float).reshape(-1, 2)
+        self.lengths = np.frombuffer(lengths, dtype=np.int_)
+        self.pathFeatures = np.frombuffer(pathFeatures, dtype=np.int_)
+
+    # arrays and properties, which usually take more than the coordinates
+    def nbytes(self):
+        return self.coords.nbytes + self.lengths.nbytes + self.pathFeatures.nbytes + valuesBytes(self.properties)
+
+    def featureCount(self):
+        return len(self.properties)
+
+    # value of a property for every feature
+    def column(self, key):
+        return [properties[key] for properties in self.properties]
+
+class CachedLayer(ParsedLayer):
+
+    # every path of a geojson file from its binary copy (see geometrycache.py); coordinates are
+    #   memory-mapped unless a threshold picks a level of detail, and properties are read one
+    #   column at a time as they are used
+    def __init__(self, filename, threshold=None):
+        self.filename = filename
+        self.table = openGeometry(filename)
+        offsets = np.asarray(self.table.pathOffsets)
+        self.coords = self.table.coords
+        self.lengths = np.diff(offsets)
+        self.pathFeatures = np.repeat(np.arange(len(self.table)), self.table.featurePathCounts())
+        if threshold is not None and self.table.thresholds is not None:
+            thresholds = np.asarray(self.table.thresholds)
+            # endpoints have no threshold and are always kept
+            with np.errstate(invalid='ignore'):
+                keep = np.isnan(thresholds) | (thresholds >= threshold)
+            self.coords = self.coords[keep]
+            self.lengths = np.diff(np.concatenate(([0], np.cumsum(keep)))[offsets])
+
+    @property
+    def properties(self):
+        return self.table.properties()
+
+    # only what was copied out of the memory map counts, and the properties read so far
+    def nbytes(self):
+        coordBytes = self.coords.nbytes if self.coords is not self.table.coords else 0
+        propertyBytes = sum([valuesBytes(column) for column in self.table.columns.values()])
+        if self.table.rows is not None:
+            propertyBytes += valuesBytes(self.table.rows)
+        return coordBytes + self.lengths.nbytes + self.pathFeatures.nbytes + propertyBytes
+
+    def featureCount(self):
+        return len(self.table)
+
+    def column(self, key):
+        return self.table.column(key)
+
+class ParsedPoints(ParsedLayer):
+
+    # read a csv file of points, one per row, with their lng/lat in the given columns; unique
+    #   keeps only the first row at each lng/lat with the same label
+    def __init__(self, filename, lngColumn, latColumn, label=None, unique=False):
+        self.filename = filename
+        self.properties = []
+        buf = array('d')
+        seen = set()
+        with open(filename, 'rb') as f:
+            for row in csv.DictReader(f):
+                lnglat = (float(row[lngColumn]), float(row[latColumn]))
+                if unique:
+                    key = (lnglat, row.get(label))
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                buf.append(lnglat[0])
+                buf.append(lnglat[1])
+                self.properties.append(row)
+        self.coords = np.frombuffer(buf, dtype=float).reshape(-1, 2)
+        # every point is a path of one
+        self.lengths = np.ones(len(self.properties), dtype=np.int_)
+        self.pathFeatures = np.arange(len(self.properties))
+
+    # copy keeping only the points in mask
+    def subset(self, mask):
+        points = copy.copy(self)
+        points.coords = self.coords[mask]
+        points.properties = [properties for (properties, keep) in zip(self.properties, mask) if keep]
+        points.lengths = self.lengths[mask]
+        points.pathFeatures = np.arange(len(points.properties))
+        return points
+
+# least recently used cache bounded by the total bytes of what it holds
+class LayerCache(object):
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.items = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key):
+        if key not in self.items:
+            return None
+        item = self.items.pop(key)
+        self.items[key] = item
+        return item[0]
+
+    def put(self, key, value, nbytes):
+        if key in self.items:
+            self.nbytes -= self.items.pop(key)[1]
+        self.items[key] = (value, nbytes)
+        self.nbytes += nbytes
+        # evict the oldest, but always keep what was just added
+        while self.nbytes > self.maxBytes and len(self.items) > 1:
+            (oldKey, (oldValue, oldBytes)) = self.items.popitem(last=False)
+            self.nbytes -= oldBytes
+
+# arrays of a finished FeatureStore
+STORE_ARRAYS = ['coords', 'offsets', 'pathGroups', 'pathStyles', 'pathLabels', 'groupLayers']
+
+# an array copied into shared memory, as (buffer, dtype, shape); worker processes given it when
+#   they start see the same memory rather than a copy
+def shareArray(array):
+    array = np.ascontiguousarray(array)
+    raw = RawArray(ctypes.c_char, max(array.nbytes, 1))
+    np.frombuffer(raw, dtype=array.dtype, count=array.size)[:] = array.ravel()
+    return (raw, array.dtype.str, array.shape)
+
+# numpy view of an array shared by shareArray
+def sharedArray(shared):
+    (raw, dtype, shape) = shared
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+# a finished store rebuilt from FeatureStore.share(), viewing its arrays in shared memory
+def sharedStore(shared):
+    (arrays, (layers, groups, styles, labels)) = shared
+    store = FeatureStore()
+    (store.layers, store.groups, store.styles, store.labels) = (layers, groups, styles, labels)
+    for name in STORE_ARRAYS:
+        setattr(store, name, sharedArray(arrays[name]))
+    store.chunks = None
+    return store
+
+class FeatureStore(object):
+
+    def __init__(self):
+        # layer ids, in config order
+        self.layers = []
+        # groups as {"id", "type" (layer code), "label"}, with a hash index by id
+        self.groups = []
+        self.groupIndex = {}
+        # (color, draw, strokeWidth or radius for points) and label tables, with hash indexes
+        self.styles = []
+        self.styleIndex = {}
+        self.labels = []
+        self.labelIndex = {}
+        # chunks of lng/lat coordinates, path lengths and per path codes, while adding paths
+        self.chunks = []
+
+    def addLayer(self, layerId):
+        self.layers.append(layerId)
+        return len(self.layers) - 1
+
+    # code of a group, added to layer the first time it is seen
+    def group(self, groupId, layer, label):
+        if groupId not in self.groupIndex:
+            self.groupIndex[groupId] = len(self.groups)
+            self.groups.append({
+                "id": groupId,
+                "type": layer,
+                "label": label
+            })
+        return self.groupIndex[groupId]
+
+    def style(self, color, draw, strokeWidth):
+        key = (color, draw, strokeWidth)
+        if key not in self.styleIndex:
+            self.styleIndex[key] = len(self.styles)
+            self.styles.append(key)
+        return self.styleIndex[key]
+
+    def label(self, label):
+        if label not in self.labelIndex:
+            self.labelIndex[label] = len(self.labels)
+            self.labels.append(label)
+        return self.labelIndex[label]
+
+    # add paths in bulk: an (N,2) array of their coordinates back to back, the length
+    #   of each path, and its group, style and label codes
+    def addPaths(self, coords, lengths, groups, styles, labels):
+        self.chunks.append((coords, lengths, groups, styles, labels))
+
+    # turn everything added into arrays; no paths can be added after this
+    def finish(self):
+        if self.chunks:
+            (coords, lengths, groups, styles, labels) = [np.concatenate(chunk) for chunk in zip(*self.chunks)]
+        else:
+            (coords, lengths, groups, styles, labels) = [np.zeros((0,), dtype=int)] * 5
+        self.coords = coords.reshape(-1, 2).astype(float)
+        self.offsets = np.concatenate(([0], np.cumsum(lengths, dtype=int)))
+        self.pathGroups = groups.astype(int)
+        self.pathStyles = styles.astype(int)
+        self.pathLabels = labels.astype(int)
+        self.groupLayers = np.array([group["type"] for group in self.groups], dtype=int)
+        self.chunks = None
+        return self
+
+    # the arrays of a finished store in shared memory and its tables, for sharedStore()
+    def share(self):
+        arrays = dict([(name, shareArray(getattr(self, name))) for name in STORE_ARRAYS])
+        return (arrays, (self.layers, self.groups, self.styles, self.labels))
+
+    # keep only the points in mask, a boolean array over coords
+    def filterPoints(self, mask):
+        self.coords = self.coords[mask]
+        lengths = np.add.reduceat(mask.astype(int), self.offsets[:-1]) if self.pathCount() else np.zeros((0,), dtype=int)
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)))
+        return self
+
+    def pathCount(self):
+        return len(self.offsets) - 1
+
+    # [minLng, minLat, maxLng, maxLat]
+    def bounds(self):
+        return self.coords.min(axis=0).tolist() + self.coords.max(axis=0).tolist()
+
+    # apply an affine transform to every coordinate, rounding to whole px
+    def transform(self, matrix, offset):
+        return np.round(self.coords.dot(matrix.T) + offset).astype(int)
+
+    # signed area of every path as a closed polygon, from an (N,2) array of its points;
+    #   the sign gives the direction the path winds in
+    def signedPolygonAreas(self, points):
+        starts = self.offsets[:-1]
+        ends = self.offsets[1:]
+        if not len(starts):
+            return np.zeros((0,))
+        # index of the next point, wrapping around at the end of each path
+        nxt = np.arange(1, len(points) + 1)
+        nxt[ends - 1] = starts
+        x = points[:, 0]
+        y = points[:, 1]
+        cross = x * y[nxt] - x[nxt] * y
+        return np.add.reduceat(cross, starts) / 2.0
+
+    def polygonAreas(self, points):
+        return np.abs(self.signedPolygonAreas(points))
+
+    # group codes of a layer, in the order groups were first seen
+    def layerGroups(self, layer):
+        return np.nonzero(self.groupLayers == layer)[0]
+
+    # path indexes of every group, in the order paths were added
+    def groupPaths(self):
+        order = np.argsort(self.pathGroups, kind='mergesort')
+        counts = np.bincount(self.pathGroups, minlength=len(self.groups))
+        return np.split(order, np.cumsum(counts)[:-1])
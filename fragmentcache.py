@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Description: keeps the <g> of every layer geojson2svg.py draws in a directory on disk, with a
+#   small summary of each layer's data (its bounds, convex hull and groups), so a render can
+#   place every layer without reading it and only redraw the layers whose key changed
+# Example usage:
+#   cache = FragmentCache("data/nyc.svg.fragments")
+#   markup = cache.fragment(key)
+#   if markup is None:
+#       ...
+#       cache.putFragment(key, markup)
+#   cache.prune()
+
+import hashlib
+import json
+import os
+import re
+
+# bump when fragments or summaries change, so old ones are not reused
+VERSION = 1
+
+# the files a cache writes, so prune leaves anything else in its directory alone
+CACHE_FILE = re.compile(r'^[0-9a-f]{40}\.(svg|json)(\.tmp)?$')
+
+# hash of anything json can write
+def keyHash(value):
+    return hashlib.sha1(json.dumps([VERSION, value], sort_keys=True)).hexdigest()
+
+class FragmentCache(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # files read or written since the cache was opened, which prune keeps
+        self.used = set()
+
+    def path(self, name):
+        self.used.add(name)
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        path = self.path(name)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return f.read()
+
+    # write next to the final file and swap it in, so a write that is cut off is never read
+    def write(self, name, text):
+        path = self.path(name)
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.rename(path + '.tmp', path)
+
+    def fragment(self, key):
+        return self.read('%s.svg' % key)
+
+    def putFragment(self, key, markup):
+        self.write('%s.svg' % key, markup)
+
+    def summary(self, key):
+        text = self.read('%s.json' % key)
+        return json.loads(text) if text is not None else None
+
+    def putSummary(self, key, summary):
+        self.write('%s.json' % key, json.dumps(summary))
+
+    # remove the fragments and summaries the last render didn't use, and any cut off writes
+    def prune(self):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name not in self.used and CACHE_FILE.match(name) and os.path.isfile(path):
+                os.remove(path)
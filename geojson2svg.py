@@ -3,83 +3,54 @@
 # Description: converts json file to svg
 # Example usage:
 #   python geojson2svg.py
+#   or, from a long-running process that keeps layers in memory between renders:
+#   from geojson2svg import render
+#   render("config.json", "data/nyc.svg", width=1000)
+#   or, redrawing only the layers that changed since the last render:
+#   python geojson2svg.py -fd data/nyc.svg.fragments
+#   or, several sizes and rotations of the map from one read of the layers:
+#   python geojson2svg.py -vf variants.json -j 4
 
 import argparse
+import copy
+from collections import OrderedDict
+from featurestore import CachedLayer, FeatureStore, LayerCache, ParsedLayer, ParsedPoints, shareArray, sharedArray, sharedStore
+from fragmentcache import FragmentCache, keyHash
+from geometrycache import fileHash
+from instrument import Stages
 import json
 import math
+from multiprocessing import Pool
+import numpy as np
 import os
+from polysimplify import VWBatchSimplifier
 import re
-import svgwrite
-from svgwrite import inch, px
+from spatialindex import METERS_PER_DEGREE, convexHull, snapToSegments
+from svgwriter import SVGDrawingWriter, SVGStreamWriter, circleMarkup, pathData, pathMarkup, polygonMarkup, polylineMarkup
 import sys
+from tiles import TileState, renderTiles, tileRange
 
-# input
-parser = argparse.ArgumentParser()
-parser.add_argument('-cf', dest="CONFIG_FILE", default="config.json", help="Path to input config file")
-parser.add_argument('-sf', dest="SVG_OUTPUT_FILE", default="data/nyc.svg", help="Path to output SVG file")
-parser.add_argument('-bc', dest="BG_COLOR", default="#A2CAEA", help="Background color")
-parser.add_argument('-w', dest="WIDTH", default="2000", type=int, help="Width of image in px")
-parser.add_argument('-ma', dest="MIN_AREA", default="100", type=int, help="Min width of polygon")
-parser.add_argument('-r', dest="ROTATE_DEGREES", default="-29.0", type=float, help="Degrees to rotate")
-parser.add_argument('-rs', dest="RESIZE_AMOUNT", default="0.9", type=float, help="Amount to resize")
-
-# init input
-args = parser.parse_args()
-
-# config geojson sources
-geojsons = []
-with open(args.CONFIG_FILE) as f:
-    geojsons = json.load(f)
-
-# get boundaries
-def boundaries(groups):
-    lngs = []
-    lats = []
-    for group in groups:
-        for feature in group['features']:
-            for lnglat in feature["coordinates"]:
-                lngs.append(lnglat[0])
-                lats.append(lnglat[1])
-    minLng = min(lngs)
-    maxLng = max(lngs)
-    minLat = min(lats)
-    maxLat = max(lats)
-    return [minLng, minLat, maxLng, maxLat]
-
-def getPathsRecursive(arr):
-    # this is a line
-    if isPath(arr):
-        return arr
-
-    # this is an array of lines
-    elif isinstance(arr[0], list):
-        results = []
-        for subArr in arr:
-            result = getPathsRecursive(subArr)
-            if isPath(result):
-                results.append(result)
-            else:
-                results += result
-        return results
-
-
-def isPath(arr):
-    return isinstance(arr[0], list) and isinstance(arr[0][0], float)
-
-def lnglatToPx(lnglat, bounds, width, height):
-    x = (lnglat[0] - bounds[0]) / (bounds[2] - bounds[0]) * width
-    y = (1.0 - (lnglat[1] - bounds[1]) / (bounds[3] - bounds[1])) * height
-    return (int(round(x)), int(round(y)))
+# bytes of parsed and projected layers a renderer keeps in memory
+CACHE_BYTES = 256 << 20
+# fewest points a ring keeps when simplifying on the fly
+MIN_RING_POINTS = 4
+# size in degrees of the box first searched around a point for a line to snap it to
+SNAP_RADIUS = 0.002
+# where stage timings go when profiling without a stats file
+DEFAULT_STATS_FILE = "geojson2svg_stages.json"
+# render() arguments a variant of the map may set, with their defaults
+VARIANT_DEFAULTS = {"width": 2000, "rotate": -29.0, "bgColor": "#A2CAEA", "minArea": 100, "merge": False, "dom": False, "tolerance": None}
 
-def polygonArea(corners):
-    n = len(corners) # of corners
-    area = 0.0
-    for i in range(n):
-        j = (i + 1) % n
-        area += corners[i][0] * corners[j][1]
-        area -= corners[j][0] * corners[i][1]
-    area = abs(area) / 2.0
-    return area
+# affine transform taking lng/lat to px: scale to width/height, flip y, then rotate about point0
+def lnglatToPxTransform(bounds, width, height, degrees, point0):
+    (x0, y0) = point0
+    sx = width / (bounds[2] - bounds[0])
+    sy = height / (bounds[3] - bounds[1])
+    rad = math.radians(degrees)
+    rotation = np.array([[math.cos(rad), -math.sin(rad)], [math.sin(rad), math.cos(rad)]])
+    matrix = rotation.dot([[sx, 0.0], [0.0, -sy]])
+    offset = rotation.dot([-bounds[0] * sx - x0, height + bounds[1] * sy - y0]) + [x0, y0]
+    return (matrix, offset)
 
 def resize(amount, point1, point0):
     (x1, y1) = point1
@@ -89,14 +60,6 @@ def resize(amount, point1, point0):
     y2 = (y1 - y0) * amount + y0
     return (x2, y2)
 
-def rotate(degrees, point1, point0):
-    (x1, y1) = point1
-    (x0, y0) = point0
-    rad = math.radians(degrees)
-    x2 = math.cos(rad)*(x1-x0)-math.sin(rad)*(y1-y0)+x0
-    y2 = math.sin(rad)*(x1-x0)+math.cos(rad)*(y1-y0)+y0
-    return (int(round(x2)), int(round(y2)))
-
 # string to identifier
 def strToId(s):
     s = s.lower()
@@ -106,105 +69,639 @@ def strToId(s):
     # s = re.sub('^[^a-zA-Z_]+', '_', s)
     return s
 
-groups = []
-for g in geojsons:
-    # read geojson data
-    with open(g['file']) as f:
-        geojson = json.load(f)
-        features = geojson['features']
-        print "Found %s features in %s" % (len(features), g['file'])
-        for feature in features:
-            group = feature['properties'][g['groupBy']]
-            groupId = strToId(group)
-            groupIndex = next((i for (i, g) in enumerate(groups) if g["id"] == groupId), len(groups))
-            if groupIndex >= len(groups):
-                groups.append({
-                    "id": groupId,
-                    "type": g["id"],
-                    "label": group,
-                    "features": []
-                })
-            coordinates = feature['geometry']['coordinates']
-            geoType = feature['geometry']['type']
-            color = g['color']
-            if type(color) is dict:
-                if groupId in color:
-                    color = color[groupId]
-                else:
-                    color = False
-            paths = getPathsRecursive(coordinates)
-            for path in paths:
-                groups[groupIndex]["features"].append({
-                    "label": feature['properties'][g['label']],
-                    "coordinates": path,
-                    "color": color,
-                    "draw": g['draw'],
-                    "strokeWidth": g['strokeWidth']
-                })
-
-# Determine bounds
-bounds = boundaries(groups)
-print "Bounds geo (lat/lng): [%s, %s, %s, %s]" % (bounds[0], bounds[1], bounds[2], bounds[3])
-WIDTH = args.WIDTH
-HEIGHT = int(round(WIDTH / 1.005))
-center = (WIDTH/2.0, HEIGHT/2.0)
-
-# convert everything to pixels
-xs = []
-ys = []
-for gi, group in enumerate(groups):
-    for fi, feature in enumerate(group["features"]):
-        points = []
-        for lnglat in feature["coordinates"]:
-            point = lnglatToPx(lnglat, bounds, WIDTH, HEIGHT)
-            # point = resize(args.RESIZE_AMOUNT, point, center)
-            point = rotate(args.ROTATE_DEGREES, point, center)
-            points.append(point)
-            xs.append(point[0])
-            ys.append(point[1])
-        groups[gi]["features"][fi]["points"] = points
-minX = min(xs)
-maxX = max(xs)
-minY = min(ys)
-maxY = max(ys)
-print "Bounds after rotation (px): [%s, %s, %s, %s]" % (minX, minY, maxX, maxY)
-
-# adjust pixels after rotation
-translateX = -1 * minX
-translateY = -1 * minY
-WIDTH = maxX - minX
-HEIGHT = maxY - minY
-for gi, group in enumerate(groups):
-    for fi, feature in enumerate(group["features"]):
-        for pi, point in enumerate(feature["points"]):
-            groups[gi]["features"][fi]["points"][pi] = (point[0]+translateX, point[1]+translateY)
-print "Bounds after adjustment (px): [0, 0, %s, %s]" % (WIDTH, HEIGHT)
-
-# Init svg
-dwg = svgwrite.Drawing(args.SVG_OUTPUT_FILE, size=(WIDTH*px, HEIGHT*px), profile='full')
-
-# Draw bg
-dwgBg = dwg.add(dwg.g(id='background'))
-dwgBg.add(dwg.rect(size=(WIDTH*px, HEIGHT*px), fill=args.BG_COLOR))
-print "Initialized svg with size %s x %s px" % (WIDTH, HEIGHT)
-
-# Draw features
-for g in geojsons:
-    groupsOfType = [group for group in groups if group["type"]==g["id"]]
-    dwgType = dwg.add(dwg.g(id=g["id"]))
-    for group in groupsOfType:
-        dwgFeatures = dwgType.add(dwg.g(id=group["id"]))
-        for feature in group["features"]:
-            points = feature["points"]
-            color = feature["color"]
-            if color and points:
-                if feature["draw"]=="polygon":
-                    area = polygonArea(points)
-                    if area > args.MIN_AREA:
-                        dwgFeatures.add(dwg.polygon(points=points, fill=color))
+# layers of config: the list itself, or read from the path of a config file
+def readConfig(config):
+    if isinstance(config, list):
+        return config
+    with open(config) as f:
+        return json.load(f)
+
+# how the file of a config layer is read: the columns and options of points, or the level of
+#   detail of a progressive file
+def layerOptions(g):
+    if g['draw']=="point":
+        return (g.get('lng', "Longitude"), g.get('lat', "Latitude"), g['label'], g.get('unique', False))
+    return (g.get('threshold'),)
+
+# what placing a layer takes without reading it: the lng/lat bounds and convex hull of its
+#   points, and the id of each of its groups in the order they are first seen
+def layerSummary(parsed, g):
+    groupIds = OrderedDict([(strToId(group), True) for group in parsed.column(g['groupBy'])])
+    coords = np.asarray(parsed.coords)
+    return {
+        "bounds": coords.min(axis=0).tolist() + coords.max(axis=0).tolist() if len(coords) else None,
+        "hull": convexHull(coords).tolist(),
+        "groups": groupIds.keys()
+    }
+
+# draw consecutive paths of a group that share a style as a single <path>;
+#   report holds elements and bytes before merging, elements and bytes after
+def drawMerged(svg, points, offsets, signedAreas, paths, style, report):
+    (color, draw, strokeWidth) = style
+    pathPoints = [points[offsets[i]:offsets[i+1]] for i in paths]
+    if draw=="point":
+        # circles have no path to share, so they are drawn as they are
+        for p in pathPoints:
+            svg.circle(p[0].tolist(), strokeWidth, color)
+            size = len(circleMarkup(p[0].tolist(), strokeWidth, color))
+            report[1] += size
+            report[3] += size
+        report[0] += len(paths)
+        report[2] += len(paths)
+        return
+    if draw=="polygon":
+        report[1] += sum([len(polygonMarkup(p.tolist(), color)) for p in pathPoints])
+        # wind every ring the same way so overlapping rings fill like separate polygons
+        pathPoints = [p[::-1] if signedAreas[i] < 0 else p for (i, p) in zip(paths, pathPoints)]
+        d = pathData(pathPoints, True)
+        svg.path(d, color)
+        report[3] += len(pathMarkup(d, color))
+    else:
+        report[1] += sum([len(polylineMarkup(p.tolist(), color, strokeWidth)) for p in pathPoints])
+        d = pathData(pathPoints, False)
+        svg.path(d, "none", color, strokeWidth)
+        report[3] += len(pathMarkup(d, "none", color, strokeWidth))
+    report[0] += len(paths)
+    report[2] += 1
+
+# the visible paths of a store at px points, drawn into an svg one layer at a time
+class LayerDrawing(object):
+
+    def __init__(self, store, points, visible, merge):
+        self.store = store
+        self.points = points
+        self.visible = visible
+        self.merge = merge
+        self.offsets = store.offsets.tolist()
+        self.groupPaths = store.groupPaths()
+        self.signedAreas = store.signedPolygonAreas(points) if merge else None
+        # see drawMerged
+        self.mergeReport = [0, 0, 0, 0]
+
+    # the <g> of a layer, with a <g> for each of its groups
+    def draw(self, svg, layer):
+        (store, points, offsets) = (self.store, self.points, self.offsets)
+        svg.startGroup(store.layers[layer])
+        for groupCode in store.layerGroups(layer):
+            svg.startGroup(store.groups[groupCode]["id"])
+            paths = self.groupPaths[groupCode]
+            paths = paths[self.visible[paths]]
+            if self.merge:
+                # split into runs of the same style, keeping paint order
+                styles = store.pathStyles[paths]
+                runs = np.nonzero(np.diff(styles))[0] + 1
+                for run in np.split(paths, runs) if len(paths) else []:
+                    drawMerged(svg, points, offsets, self.signedAreas, run, store.styles[store.pathStyles[run[0]]], self.mergeReport)
+                svg.endGroup()
+                continue
+            for i in paths:
+                pathPoints = points[offsets[i]:offsets[i+1]].tolist()
+                (color, draw, strokeWidth) = store.styles[store.pathStyles[i]]
+                if draw=="polygon":
+                    svg.polygon(pathPoints, color)
+                elif draw=="point":
+                    svg.circle(pathPoints[0], strokeWidth, color)
                 else:
-                    dwgFeatures.add(dwg.polyline(points=points, stroke=color, stroke_width=feature["strokeWidth"], fill="none"))
+                    svg.polyline(pathPoints, color, strokeWidth)
+            svg.endGroup()
+        svg.endGroup()
+
+# paths with a color that are big enough to see: polygons of more than minArea px squared,
+#   and every line and point
+def visiblePaths(store, points, minArea, verbose, stages):
+    with stages.stage("area-cull"):
+        styleColors = np.array([bool(color) for (color, draw, strokeWidth) in store.styles])
+        stylePolygons = np.array([draw=="polygon" for (color, draw, strokeWidth) in store.styles])
+        isPolygon = stylePolygons[store.pathStyles]
+        colored = styleColors[store.pathStyles]
+        visible = colored & (~isPolygon | (store.polygonAreas(points) > minArea))
+    lengths = np.diff(store.offsets)
+    stages.count("area-cull", verticesIn=len(points), verticesOut=int(lengths[visible].sum()), culled=int(np.count_nonzero(colored & ~visible)))
+    if verbose:
+        print "Drawing %s of %s paths" % (np.count_nonzero(visible), store.pathCount())
+    return visible
+
+# draw the visible paths of a store at px points into an svg file of width x height px, on a
+#   background of bgColor; returns the size of the image
+def saveMap(filename, store, points, width, height, bgColor, minArea, merge, dom, verbose, stages):
+    visible = visiblePaths(store, points, minArea, verbose, stages)
+    lengths = np.diff(store.offsets)
+
+    with stages.stage("draw"):
+        # Init svg
+        if dom:
+            svg = SVGDrawingWriter(filename, width, height)
+        else:
+            svg = SVGStreamWriter(filename, width, height)
+
+        # Draw bg
+        svg.startGroup('background')
+        svg.rect(bgColor)
+        svg.endGroup()
+        if verbose:
+            print "Initialized svg with size %s x %s px" % (width, height)
+
+        # Draw features, one group at a time
+        drawing = LayerDrawing(store, points, visible, merge)
+        for layer in range(len(store.layers)):
+            drawing.draw(svg, layer)
+        mergeReport = drawing.mergeReport
+    stages.count("draw", verticesIn=int(lengths[visible].sum()), features=int(np.count_nonzero(visible)))
+    if merge and verbose:
+        (elements, size, mergedElements, mergedSize) = mergeReport
+        print "Merged %s elements (%s bytes) into %s paths (%s bytes, %.1f%% of the size)" % (elements, size, mergedElements, mergedSize, 100.0 * mergedSize / max(size, 1))
+
+    # Save
+    with stages.stage("save"):
+        svg.close()
+    stages.count("save", bytes=os.path.getsize(filename))
+    if verbose:
+        print "Saved svg %s" % filename
+    return (width, height)
+
+# grouped layers shared with worker processes rendering variants: the store, its lng/lat bounds
+#   and the threshold of every vertex (None unless a variant simplifies)
+variantState = None
+
+# set up a worker process from the arrays of a store in shared memory (see FeatureStore.share)
+def setVariantState(shared, bounds, thresholds):
+    global variantState
+    variantState = (sharedStore(shared), bounds, sharedArray(thresholds) if thresholds is not None else None)
+
+# draw one variant of the map, placed as Renderer.project() places it; returns (file, width,
+#   height, paths drawn)
+def renderVariant(variant):
+    (store, bounds, thresholds) = variantState
+    stages = Stages()
+    width = variant["width"]
+    height = int(round(width / 1.005))
+    center = (width/2.0, height/2.0)
+    (matrix, offset) = lnglatToPxTransform(bounds, width, height, variant["rotate"], center)
+    points = store.transform(matrix, offset)
+    minX, minY = points.min(axis=0).tolist()
+    maxX, maxY = points.max(axis=0).tolist()
+    points -= [minX, minY]
+    if variant["tolerance"]:
+        mask = thresholds >= variant["tolerance"] / abs(np.linalg.det(matrix))
+        # filtering replaces the arrays of the copy, the shared ones are left as they are
+        store = copy.copy(store).filterPoints(mask)
+        points = points[mask]
+    (width, height) = saveMap(variant["file"], store, points, maxX - minX, maxY - minY, variant["bgColor"], variant["minArea"], variant["merge"], variant["dom"], False, stages)
+    return (variant["file"], width, height, stages.get("draw")["features"])
+
+class Renderer(object):
+
+    # parsed and projected layers are kept in memory between renders, up to cacheBytes;
+    #   with geometryCache, geojson files are read from binary copies made on first use
+    def __init__(self, cacheBytes=CACHE_BYTES, geometryCache=False):
+        self.cache = LayerCache(cacheBytes)
+        self.geometryCache = geometryCache
+        # content hashes of files by (path, size, modification time)
+        self.fileHashes = {}
+
+    def fileHash(self, filename):
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+        if key not in self.fileHashes:
+            self.fileHashes[key] = fileHash(filename)
+        return self.fileHashes[key]
+
+    # hash of everything the paths and groups of a config layer come from: the contents of its
+    #   file, how it is read and grouped, and the same for the layer it snaps to
+    def layerDataKey(self, g, configs):
+        parts = [self.fileHash(g['file']), g['draw']=="point", layerOptions(g), g['groupBy']]
+        if 'snapTo' in g:
+            parts += [self.layerDataKey(configs[g['snapTo']], configs), g['snapBy'], g.get('snapWithin')]
+        return keyHash(parts)
+
+    # parsed geojson of a config layer, read again only when its file changes
+    def readLayer(self, g):
+        filename = os.path.abspath(g['file'])
+        options = layerOptions(g)
+        key = ('layer', filename, os.path.getmtime(filename)) + options
+        parsed = self.cache.get(key)
+        if parsed is None:
+            if g['draw']=="point":
+                parsed = ParsedPoints(filename, *options)
+            elif self.geometryCache:
+                parsed = CachedLayer(filename, *options)
+                # read the columns every render uses now, so they count toward the cache's bound
+                for column in [g['groupBy'], g['label']]:
+                    parsed.column(column)
+            else:
+                parsed = ParsedLayer(filename, *options)
+            self.cache.put(key, parsed, parsed.nbytes())
+        return (key, parsed)
+
+    # a point layer moved onto the nearest line of the layer target, keeping to the groups
+    #   named in the point's columns starting with snapBy; points more than snapWithin meters
+    #   away, or with none of their groups in target, are dropped if snapWithin is set. Returns
+    #   the key it is cached under, which covers how it was snapped, and the snapped layer
+    def snapLayer(self, key, parsed, g, targetKey, target, targetConfig, verbose):
+        cacheKey = ('snapped', key, targetKey, g['snapBy'], targetConfig['groupBy'], g.get('snapWithin'))
+        snapped = self.cache.get(cacheKey)
+        if snapped is not None:
+            return (cacheKey, snapped)
+
+        # segments of every line of the target, with the group each belongs to
+        groupCodes = {}
+        featureGroups = np.array([groupCodes.setdefault(strToId(group), len(groupCodes)) for group in target.column(targetConfig['groupBy'])], dtype=int)
+        offsets = np.concatenate(([0], np.cumsum(target.lengths)))
+        inner = np.ones(max(len(target.coords) - 1, 0), dtype=bool)
+        inner[offsets[1:-1] - 1] = False
+        starts = target.coords[:-1][inner]
+        ends = target.coords[1:][inner]
+        segmentGroups = np.repeat(featureGroups[target.pathFeatures], target.lengths)[:-1][inner]
+
+        # groups each point may snap to
+        columns = [column for column in sorted(parsed.properties[0]) if column.startswith(g['snapBy'])] if parsed.properties else []
+        allowed = []
+        for properties in parsed.properties:
+            groupIds = [strToId(properties[column].strip()) for column in columns]
+            allowed.append(set([groupCodes[groupId] for groupId in groupIds if groupId in groupCodes]))
+
+        # measure in local units where a degree of lng is as long as it is at this latitude
+        scale = np.array([math.cos(math.radians(parsed.coords[:, 1].mean())) if len(parsed.coords) else 1.0, 1.0])
+        (points, distances) = snapToSegments(parsed.coords * scale, allowed, starts * scale, ends * scale, segmentGroups, SNAP_RADIUS)
+        snapped = copy.copy(parsed)
+        snapped.coords = points / scale
+        moved = distances * METERS_PER_DEGREE
+        # points too far from their lines are most likely misplaced, so they are left out
+        if 'snapWithin' in g:
+            snapped = snapped.subset(moved <= g['snapWithin'])
+            moved = moved[moved <= g['snapWithin']]
+        self.cache.put(cacheKey, snapped, snapped.nbytes())
+        if verbose:
+            moved = moved[np.isfinite(moved)]
+            print "Snapped %s of %s points in %s to %s, moving them %.0f m on average (at most %.0f m)" % (len(moved), parsed.featureCount(), g['file'], targetConfig['id'], moved.mean() if len(moved) else 0, moved.max() if len(moved) else 0)
+        return (cacheKey, snapped)
+
+    # px coordinates of every path, shifted so the top left is (0, 0), with the image size
+    #   and the px squared in one lng/lat squared
+    def project(self, layerKeys, store, width, rotate, verbose, stages):
+        key = ('projected', tuple(layerKeys), width, rotate)
+        projected = self.cache.get(key)
+        if projected is not None:
+            return projected
+
+        # Determine bounds
+        with stages.stage("bounds"):
+            bounds = store.bounds()
+        if verbose:
+            print "Bounds geo (lat/lng): [%s, %s, %s, %s]" % (bounds[0], bounds[1], bounds[2], bounds[3])
+        height = int(round(width / 1.005))
+        center = (width/2.0, height/2.0)
+
+        # convert everything to pixels, rotated, in one transform
+        with stages.stage("project"):
+            (matrix, offset) = lnglatToPxTransform(bounds, width, height, rotate, center)
+            points = store.transform(matrix, offset)
+        stages.count("project", verticesIn=len(points), verticesOut=len(points))
+
+        # adjust pixels after rotation
+        with stages.stage("rotate"):
+            minX, minY = points.min(axis=0).tolist()
+            maxX, maxY = points.max(axis=0).tolist()
+            points -= [minX, minY]
+        if verbose:
+            print "Bounds after rotation (px): [%s, %s, %s, %s]" % (minX, minY, maxX, maxY)
+        # affine maps scale every area the same, by the determinant
+        projected = (points, maxX - minX, maxY - minY, abs(np.linalg.det(matrix)))
+        self.cache.put(key, projected, points.nbytes)
+        return projected
+
+    # (cache key, parsed layer, config) of the layers of geojsons at indices, with point layers
+    #   that follow the lines of another layer snapped to it; a snapped layer's key is the one
+    #   it is cached under, so projections and thresholds keyed on it follow how it was snapped
+    def loadLayers(self, geojsons, indices, verbose):
+        layerIndex = dict([(g["id"], i) for (i, g) in enumerate(geojsons)])
+        loaded = {}
+        def load(i):
+            if i not in loaded:
+                g = geojsons[i]
+                (key, parsed) = self.readLayer(g)
+                if 'snapTo' in g:
+                    (targetKey, target, targetConfig) = load(layerIndex[g['snapTo']])
+                    (key, parsed) = self.snapLayer(key, parsed, g, targetKey, target, targetConfig, verbose)
+                loaded[i] = (key, parsed, g)
+            return loaded[i]
+        return [load(i) for i in indices]
+
+    # store of the layers of config (a list of layers, or the path of a config file), and the
+    #   (cache key, parsed layer, config) of each layer
+    def buildStore(self, config, verbose, stages):
+        with stages.stage("load"):
+            geojsons = readConfig(config)
+            layers = self.loadLayers(geojsons, range(len(geojsons)), verbose)
+        vertices = sum([len(parsed.coords) for (key, parsed, g) in layers])
+        stages.count("load", features=sum([parsed.featureCount() for (key, parsed, g) in layers]), verticesOut=vertices)
+
+        with stages.stage("group"):
+            store = self.groupLayers(layers, verbose)
+        stages.count("group", verticesIn=vertices, verticesOut=len(store.coords))
+        return (store, layers)
+
+    # store of parsed layers, with the group, style and label of every path
+    def groupLayers(self, layers, verbose):
+        store = FeatureStore()
+        for (key, parsed, g) in layers:
+            layer = store.addLayer(g["id"])
+            # codes of every feature; groups are added even when their feature has no paths
+            featureGroups = np.zeros(parsed.featureCount(), dtype=int)
+            featureStyles = np.zeros(parsed.featureCount(), dtype=int)
+            featureLabels = np.zeros(parsed.featureCount(), dtype=int)
+            for (i, (group, label)) in enumerate(zip(parsed.column(g['groupBy']), parsed.column(g['label']))):
+                groupId = strToId(group)
+                featureGroups[i] = store.group(groupId, layer, group)
+                color = g['color']
+                if type(color) is dict:
+                    if groupId in color:
+                        color = color[groupId]
+                    else:
+                        color = False
+                featureStyles[i] = store.style(color, g['draw'], g['radius'] if g['draw']=="point" else g['strokeWidth'])
+                featureLabels[i] = store.label(label)
+            pathFeatures = parsed.pathFeatures
+            store.addPaths(parsed.coords, parsed.lengths, featureGroups[pathFeatures], featureStyles[pathFeatures], featureLabels[pathFeatures])
+            if verbose:
+                print "Found %s features in %s" % (parsed.featureCount(), g['file'])
+        return store.finish()
+
+    # vertex thresholds of a parsed layer in lng/lat squared; polygons always keep enough
+    #   vertices to stay rings
+    def layerThresholds(self, key, parsed, isPolygon):
+        key = ('thresholds', key, isPolygon)
+        thresholds = self.cache.get(key)
+        if thresholds is None:
+            offsets = np.concatenate(([0], np.cumsum(parsed.lengths)))
+            simplifier = VWBatchSimplifier(parsed.coords, offsets)
+            thresholds = simplifier.thresholds
+            if isPolygon:
+                thresholds = np.where(simplifier.mask_from_number(MIN_RING_POINTS), np.inf, thresholds)
+            self.cache.put(key, thresholds, thresholds.nbytes)
+        return thresholds
+
+    # mask of the vertices whose effective area is at least tolerance px squared
+    def detailMask(self, layers, tolerance, pxPerArea):
+        thresholds = [self.layerThresholds(key, parsed, g['draw']=="polygon") for (key, parsed, g) in layers]
+        return np.concatenate(thresholds + [np.zeros((0,))]) >= tolerance / pxPerArea
+
+    # render the layers of config (a list of layers, or the path of a config file) to an svg file,
+    #   simplified to tolerance px squared if given; time and counts of each stage go to stages
+    #   if given. With fragmentDir, the <g> of every layer is kept there and only layers that
+    #   changed are redrawn (see renderFragments). Returns the size of the image
+    def render(self, config, filename, width=2000, rotate=-29.0, bgColor="#A2CAEA", minArea=100, merge=False, dom=False, verbose=True, tolerance=None, stages=None, fragmentDir=None):
+        stages = stages or Stages()
+        if fragmentDir:
+            if dom:
+                raise ValueError("Layers kept in a fragment directory can only be drawn by the streaming writer")
+            return self.renderFragments(config, filename, fragmentDir, width, rotate, bgColor, minArea, merge, verbose, tolerance, stages)
+        (store, layers) = self.buildStore(config, verbose, stages)
+        (points, width, height, pxPerArea) = self.project([key for (key, parsed, g) in layers], store, width, rotate, verbose, stages)
+        if verbose:
+            print "Bounds after adjustment (px): [0, 0, %s, %s]" % (width, height)
+
+        # keep just the vertices that make a visible difference at this size
+        if tolerance:
+            with stages.stage("simplify"):
+                mask = self.detailMask(layers, tolerance, pxPerArea)
+                store.filterPoints(mask)
+                points = points[mask]
+            stages.count("simplify", verticesIn=len(mask), verticesOut=len(points))
+            if verbose:
+                print "Simplified to %s of %s points at %s px2" % (len(points), len(mask), tolerance)
+
+        return saveMap(filename, store, points, width, height, bgColor, minArea, merge, dom, verbose, stages)
+
+    # render like render(), keeping the <g> of every layer in directory under a key of its config,
+    #   its data and where the map puts it; layers whose key is unchanged are copied from there
+    #   and the rest are read and drawn. The size and placement of the map come from summaries of
+    #   each layer's data, also kept in directory, so unchanged layers are never read
+    def renderFragments(self, config, filename, directory, width, rotate, bgColor, minArea, merge, verbose, tolerance, stages):
+        fragments = FragmentCache(directory)
+        with stages.stage("load"):
+            geojsons = readConfig(config)
+            configs = dict([(g["id"], g) for g in geojsons])
+            dataKeys = [self.layerDataKey(g, configs) for g in geojsons]
+            summaries = [fragments.summary(key) for key in dataKeys]
+            unknown = [i for (i, summary) in enumerate(summaries) if summary is None]
+            for (i, (key, parsed, g)) in zip(unknown, self.loadLayers(geojsons, unknown, verbose)):
+                summaries[i] = layerSummary(parsed, g)
+                fragments.putSummary(dataKeys[i], summaries[i])
+
+        # place the map as project() would, from the bounds and hulls of every layer
+        with stages.stage("bounds"):
+            layerBounds = np.array([summary["bounds"] for summary in summaries if summary["bounds"]])
+            bounds = layerBounds[:, :2].min(axis=0).tolist() + layerBounds[:, 2:].max(axis=0).tolist()
+        if verbose:
+            print "Bounds geo (lat/lng): [%s, %s, %s, %s]" % (bounds[0], bounds[1], bounds[2], bounds[3])
+        height = int(round(width / 1.005))
+        center = (width/2.0, height/2.0)
+        with stages.stage("project"):
+            (matrix, offset) = lnglatToPxTransform(bounds, width, height, rotate, center)
+            hulls = np.concatenate([np.array(summary["hull"], dtype=float).reshape(-1, 2) for summary in summaries])
+            corners = np.round(hulls.dot(matrix.T) + offset).astype(int)
+            minX, minY = corners.min(axis=0).tolist()
+            maxX, maxY = corners.max(axis=0).tolist()
+        if verbose:
+            print "Bounds after rotation (px): [%s, %s, %s, %s]" % (minX, minY, maxX, maxY)
+        (width, height) = (maxX - minX, maxY - minY)
+        if verbose:
+            print "Bounds after adjustment (px): [0, 0, %s, %s]" % (width, height)
+
+        # a group seen in several layers is drawn in the first of them, with the paths of all of
+        #   them, so layers sharing groups depend on each other
+        groupSets = [set(summary["groups"]) for summary in summaries]
+        partners = [[j for j in range(len(geojsons)) if j != i and groupSets[i] & groupSets[j]] for i in range(len(geojsons))]
+        placement = [width, rotate, minArea, merge, tolerance, matrix.tolist(), offset.tolist(), [minX, minY]]
+        keys = [keyHash([g, dataKeys[i], [[j < i, geojsons[j], dataKeys[j]] for j in partners[i]]] + placement) for (i, g) in enumerate(geojsons)]
+        markups = [fragments.fragment(key) for key in keys]
+        stale = [i for (i, markup) in enumerate(markups) if markup is None]
+
+        # read and draw just the stale layers, and the layers they share groups with
+        if stale:
+            needed = sorted(set(stale + [j for i in stale for j in partners[i]]))
+            with stages.stage("load"):
+                layers = self.loadLayers(geojsons, needed, verbose)
+            with stages.stage("group"):
+                store = self.groupLayers(layers, verbose)
+            with stages.stage("project"):
+                points = store.transform(matrix, offset) - [minX, minY]
+            if tolerance:
+                with stages.stage("simplify"):
+                    mask = self.detailMask(layers, tolerance, abs(np.linalg.det(matrix)))
+                    store.filterPoints(mask)
+                    points = points[mask]
+                stages.count("simplify", verticesIn=len(mask), verticesOut=len(points))
+            drawing = LayerDrawing(store, points, visiblePaths(store, points, minArea, verbose, stages), merge)
+        stages.count("draw", redrawn=len(stale), reused=len(geojsons) - len(stale))
+        if verbose:
+            print "Redrawing %s of %s layers, the rest are kept in %s" % (len(stale), len(geojsons), directory)
+
+        with stages.stage("draw"):
+            svg = SVGStreamWriter(filename, width, height)
+            svg.startGroup('background')
+            svg.rect(bgColor)
+            svg.endGroup()
+            for (i, key) in enumerate(keys):
+                if markups[i] is not None:
+                    svg.markup(markups[i])
+                    continue
+                svg.startCapture()
+                drawing.draw(svg, needed.index(i))
+                fragments.putFragment(key, svg.endCapture())
+        with stages.stage("save"):
+            svg.close()
+            fragments.prune()
+        stages.count("save", bytes=os.path.getsize(filename))
+        if verbose:
+            print "Saved svg %s" % filename
+        return (width, height)
+
+    # render several variants of the map of config, each a dict with the file to write and any of
+    #   the keys of VARIANT_DEFAULTS; layers are read, grouped and bounded once and the variants
+    #   drawn across jobs worker processes, which see the grouped layers in shared memory rather
+    #   than a pickled copy. Returns (file, width, height, paths drawn) of every variant
+    def renderVariants(self, config, variants, jobs=1, verbose=True, stages=None):
+        stages = stages or Stages()
+        variants = [dict(VARIANT_DEFAULTS, **variant) for variant in variants]
+        (store, layers) = self.buildStore(config, verbose, stages)
+        with stages.stage("bounds"):
+            bounds = store.bounds()
+        if verbose:
+            print "Bounds geo (lat/lng): [%s, %s, %s, %s]" % (bounds[0], bounds[1], bounds[2], bounds[3])
+        thresholds = None
+        if any([variant["tolerance"] for variant in variants]):
+            with stages.stage("simplify"):
+                thresholds = np.concatenate([self.layerThresholds(key, parsed, g['draw']=="polygon") for (key, parsed, g) in layers] + [np.zeros((0,))])
+        with stages.stage("share"):
+            state = (store.share(), bounds, shareArray(thresholds) if thresholds is not None else None)
+        with stages.stage("draw"):
+            if jobs <= 1:
+                setVariantState(*state)
+                results = [renderVariant(variant) for variant in variants]
+            else:
+                pool = Pool(jobs, setVariantState, state)
+                try:
+                    results = pool.map(renderVariant, variants, 1)
+                finally:
+                    pool.close()
+                    pool.join()
+        stages.count("draw", features=sum([result[3] for result in results]), variants=len(results))
+        stages.count("save", bytes=sum([os.path.getsize(result[0]) for result in results]))
+        if verbose:
+            for (filename, width, height, drawn) in results:
+                print "Saved svg %s (%s x %s px, %s paths)" % (filename, width, height, drawn)
+        return results
+
+    # render the layers of config to a z/x/y pyramid of square svg tiles in directory, with the
+    #   whole map fitting in the one tile of zoom 0; returns (z, x, y, paths drawn) of every tile
+    def renderTiles(self, config, directory, zooms, tileSize=256, rotate=-29.0, bgColor="#A2CAEA", minArea=100, jobs=1, verbose=True, stages=None):
+        stages = stages or Stages()
+        (store, layers) = self.buildStore(config, verbose, stages)
+
+        # project to unrounded px with room to spare, tiles round after scaling to their zoom
+        with stages.stage("bounds"):
+            bounds = store.bounds()
+        with stages.stage("project"):
+            height = int(round(tileSize / 1.005))
+            (matrix, offset) = lnglatToPxTransform(bounds, tileSize, height, rotate, (tileSize/2.0, height/2.0))
+            points = store.coords.dot(matrix.T) + offset
+        with stages.stage("rotate"):
+            points -= points.min(axis=0)
+            (width, height) = points.max(axis=0).tolist()
+            worldSize = max(width, height)
+
+        with stages.stage("index"):
+            # paths with a color, in the order the full map paints them
+            styleColors = np.array([bool(color) for (color, draw, strokeWidth) in store.styles])
+            groupPaths = store.groupPaths()
+            drawOrder = np.concatenate([groupPaths[groupCode] for layer in range(len(store.layers)) for groupCode in store.layerGroups(layer)] + [np.zeros((0,), dtype=int)])
+            drawOrder = drawOrder[styleColors[store.pathStyles[drawOrder]]]
+            state = TileState(directory, tileSize, worldSize, points, store.offsets, store.polygonAreas(points), drawOrder, store.pathGroups, store.pathStyles, store, bgColor, minArea, max(zooms))
+            tiles = tileRange(zooms, state, width, height)
+        if verbose:
+            print "Rendering %s tiles at zoom %s with %s paths indexed" % (len(tiles), ','.join(map(str, zooms)), len(drawOrder))
+        with stages.stage("draw"):
+            results = renderTiles(state, tiles, jobs)
+        stages.count("draw", features=sum([result[3] for result in results]), tiles=len(results))
+        if verbose:
+            for z in zooms:
+                drawn = [result[3] for result in results if result[0] == z]
+                print "Zoom %s: %s tiles, %s paths drawn (at most %s in a tile)" % (z, len(drawn), sum(drawn), max(drawn) if drawn else 0)
+            print "Saved tiles to %s" % directory
+        return results
+
+# renderer shared by calls to render(), so layers stay cached between them
+defaultRenderer = None
+
+def render(config, filename, width=2000, rotate=-29.0, bgColor="#A2CAEA", minArea=100, merge=False, dom=False, verbose=True, tolerance=None, stages=None, fragmentDir=None):
+    global defaultRenderer
+    if defaultRenderer is None:
+        defaultRenderer = Renderer()
+    return defaultRenderer.render(config, filename, width, rotate, bgColor, minArea, merge, dom, verbose, tolerance, stages, fragmentDir)
+
+def renderTileSet(config, directory, zooms, tileSize=256, rotate=-29.0, bgColor="#A2CAEA", minArea=100, jobs=1, verbose=True, stages=None):
+    global defaultRenderer
+    if defaultRenderer is None:
+        defaultRenderer = Renderer()
+    return defaultRenderer.renderTiles(config, directory, zooms, tileSize, rotate, bgColor, minArea, jobs, verbose, stages)
+
+def renderVariantSet(config, variants, jobs=1, verbose=True, stages=None):
+    global defaultRenderer
+    if defaultRenderer is None:
+        defaultRenderer = Renderer()
+    return defaultRenderer.renderVariants(config, variants, jobs, verbose, stages)
+
+# zoom levels from '3' or a range like '0-4'
+def parseZooms(zooms):
+    (first, _, last) = zooms.partition('-')
+    return range(int(first), int(last or first) + 1)
+
+if __name__ == "__main__":
+    # input
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-cf', dest="CONFIG_FILE", default="config.json", help="Path to input config file")
+    parser.add_argument('-sf', dest="SVG_OUTPUT_FILE", default="data/nyc.svg", help="Path to output SVG file")
+    parser.add_argument('-bc', dest="BG_COLOR", default="#A2CAEA", help="Background color")
+    parser.add_argument('-w', dest="WIDTH", default="2000", type=int, help="Width of image in px")
+    parser.add_argument('-ma', dest="MIN_AREA", default="100", type=int, help="Min width of polygon")
+    parser.add_argument('-r', dest="ROTATE_DEGREES", default="-29.0", type=float, help="Degrees to rotate")
+    parser.add_argument('-rs', dest="RESIZE_AMOUNT", default="0.9", type=float, help="Amount to resize")
+    parser.add_argument('-mg', '--merge', dest="MERGE", action="store_true", help="Merge the paths of each group that share a style into one compact <path>")
+    parser.add_argument('-dom', dest="DOM", action="store_true", help="Build and validate the whole drawing with svgwrite before saving, instead of streaming it")
+    parser.add_argument('-tol', dest="TOLERANCE", default=None, type=float, help="Simplify on the fly for the output size, dropping vertices whose effective area is below this many px squared (e.g. 0.5); works best with full resolution files")
+    parser.add_argument('-tz', '--tiles', dest="TILE_ZOOMS", default=None, help="Write a z/x/y pyramid of svg tiles at these zoom levels (e.g. 0-4) instead of one svg")
+    parser.add_argument('-td', dest="TILE_DIR", default="data/tiles", help="Directory to write tiles to")
+    parser.add_argument('-ts', dest="TILE_SIZE", default="256", type=int, help="Width and height of each tile in px")
+    parser.add_argument('-vf', dest="VARIANTS_FILE", default=None, help="Path to a json list of variants to render from one read of the layers, each with the file to write and any of width, rotate, bgColor, minArea, merge, dom and tolerance (the rest come from the other options)")
+    parser.add_argument('-j', '--jobs', dest="JOBS", default="1", type=int, help="Number of worker processes rendering tiles or variants")
+    parser.add_argument('-gc', '--geometry-cache', dest="GEOMETRY_CACHE", action="store_true", help="Read geojson files from memory-mapped binary copies, made next to them on first use and whenever they change")
+    parser.add_argument('-fd', dest="FRAGMENT_DIR", default=None, help="Keep the svg of every layer in this directory and redraw only the layers whose config, data or placement changed since the last render")
+    parser.add_argument('-ss', dest="STATS_FILE", default=None, help="Write the time, vertices, culled paths and bytes of each stage to this json file")
+    parser.add_argument('-pf', '--profile', dest="PROFILE", action="store_true", help="Also profile each stage with cProfile and save the slowest stage's stats next to the stats file")
+
+    # init input
+    args = parser.parse_args()
+    if args.FRAGMENT_DIR and args.DOM:
+        parser.error("-fd writes layers kept on disk as they are and can't be combined with -dom")
+    if args.VARIANTS_FILE and (args.FRAGMENT_DIR or args.TILE_ZOOMS is not None):
+        parser.error("-vf renders whole maps and can't be combined with -fd or --tiles")
+    if args.TILE_ZOOMS is not None and (args.FRAGMENT_DIR or args.MERGE or args.DOM or args.TOLERANCE is not None):
+        parser.error("--tiles draws each tile from its own cut of the layers and can't be combined with -fd, -mg, -dom or -tol")
+
+    stages = Stages(args.PROFILE)
+    defaultRenderer = Renderer(geometryCache=args.GEOMETRY_CACHE)
+
+    if args.VARIANTS_FILE:
+        defaults = {"width": args.WIDTH, "rotate": args.ROTATE_DEGREES, "bgColor": args.BG_COLOR, "minArea": args.MIN_AREA, "merge": args.MERGE, "dom": args.DOM, "tolerance": args.TOLERANCE}
+        with open(args.VARIANTS_FILE) as f:
+            variants = [dict(defaults, **variant) for variant in json.load(f)]
+        renderVariantSet(args.CONFIG_FILE, variants, args.JOBS, stages=stages)
+    elif args.TILE_ZOOMS is not None:
+        renderTileSet(args.CONFIG_FILE, args.TILE_DIR, parseZooms(args.TILE_ZOOMS), args.TILE_SIZE, args.ROTATE_DEGREES, args.BG_COLOR, args.MIN_AREA, args.JOBS, stages=stages)
+    else:
+        render(args.CONFIG_FILE, args.SVG_OUTPUT_FILE, args.WIDTH, args.ROTATE_DEGREES, args.BG_COLOR, args.MIN_AREA, args.MERGE, args.DOM, tolerance=args.TOLERANCE, stages=stages, fragmentDir=args.FRAGMENT_DIR)
 
-# Save
-dwg.save()
-print "Saved svg %s" % args.SVG_OUTPUT_FILE
+    if args.STATS_FILE or args.PROFILE:
+        stages.save(args.STATS_FILE or DEFAULT_STATS_FILE)
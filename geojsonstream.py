@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# Description: reads and writes geojson FeatureCollections one feature at a time,
+#   so memory stays flat no matter how many features a file has, and reads
+#   progressive geometries written by simplifygeojson.py -pg; coordinates already
+#   rounded to a precision can be written with a bulk formatter instead of json
+# Example usage:
+#   with open(inputFile) as f, open(outputFile, 'w') as g:
+#       reader = FeatureReader(f)
+#       writer = None
+#       for feature in reader:
+#           writer = writer or FeatureWriter(g, reader.header)
+#           writer.write(feature)
+#       writer.close(reader.footer)
+
+from itertools import chain
+import json
+
+CHUNK_SIZE = 1 << 16
+WHITESPACE = ' \t\n\r'
+FEATURES_MARKER = '__features__'
+COORDINATES_MARKER = '__coordinates__'
+
+class FeatureReader(object):
+
+    # objectPairsHook is passed on to the json decoder, e.g. OrderedDict to keep the order of keys
+    def __init__(self, f, chunkSize=CHUNK_SIZE, objectPairsHook=None):
+        self.f = f
+        self.chunkSize = chunkSize
+        self.decoder = json.JSONDecoder(object_pairs_hook=objectPairsHook)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        # top-level members before and after the features array, as (key, value) pairs
+        self.header = []
+        self.footer = []
+
+    # read more of the file into the buffer, returns False at end of file
+    def fill(self, size=None):
+        if self.eof:
+            return False
+        # drop what has already been parsed
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        data = self.f.read(max(size or 0, self.chunkSize))
+        if not data:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    # return the next non-whitespace character without consuming it
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of geojson file")
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError("Expected one of %s but found %s in geojson file" % (chars, c))
+        self.pos += 1
+        return c
+
+    # decode one json value, reading more of the file until it is complete
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # value is cut off by the end of the buffer; grow reads geometrically
+                if not self.fill(len(self.buf)):
+                    raise
+                continue
+            # a number at the very end of the buffer may be cut off too
+            if end < len(self.buf) or not self.fill():
+                self.pos = end
+                return value
+
+    def __iter__(self):
+        self.expect('{')
+        members = self.header
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            if key == 'features':
+                self.expect('[')
+                if self.peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self.value()
+                        if self.expect(',]') == ']':
+                            break
+                members = self.footer
+            else:
+                members.append((key, self.value()))
+            if self.expect(',}') == '}':
+                break
+
+# json text of a line of points rounded to precision decimal places, formatted all at once
+#   rather than one float at a time; enough significant digits for the largest value keep every
+#   decimal, and %g drops the trailing zeros rounding leaves, as repr would
+def formatLine(line, precision):
+    if not line:
+        return '[]'
+    flat = tuple(chain.from_iterable(line))
+    # %g writes whole numbers without a point, and they would be read back as ints, so lines
+    #   with any are left to json
+    try:
+        if any(map(float.is_integer, flat)):
+            return json.dumps(line)
+    except TypeError:
+        return json.dumps(line)
+    digits = precision + len('%d' % max(max(flat), -min(flat)))
+    point = '[%%.%sg, %%.%sg]' % (digits, digits)
+    return '[' + ', '.join([point] * len(line)) % flat + ']'
+
+# json text of the coordinates of any geometry, rounded to precision decimal places
+def formatCoordinates(coordinates, precision):
+    # this is a position
+    if coordinates and not isinstance(coordinates[0], list):
+        return formatLine([coordinates], precision)[1:-1]
+
+    # this is a line
+    if not coordinates or not isinstance(coordinates[0][0], list):
+        return formatLine(coordinates, precision)
+
+    # this is an array of lines
+    return '[' + ', '.join([formatCoordinates(c, precision) for c in coordinates]) + ']'
+
+# json text of a feature, with its coordinates formatted by formatCoordinates if precision is given
+def dumpFeature(feature, precision=None):
+    geometry = feature.get('geometry')
+    if precision is None or not geometry or 'coordinates' not in geometry:
+        return json.dumps(feature)
+    # dump the feature around a marker and put the formatted coordinates in its place
+    coordinates = geometry['coordinates']
+    geometry['coordinates'] = COORDINATES_MARKER
+    try:
+        text = json.dumps(feature)
+    finally:
+        geometry['coordinates'] = coordinates
+    return text.replace(json.dumps(COORDINATES_MARKER), formatCoordinates(coordinates, precision), 1)
+
+class FeatureWriter(object):
+
+    # precision is the decimal places coordinates were rounded to, if they were
+    def __init__(self, f, header, precision=None):
+        self.f = f
+        self.precision = precision
+        self.count = 0
+        # dump the top-level object around a marker so members come out as json.dump would write them
+        members = dict(header)
+        members['features'] = FEATURES_MARKER
+        (self.prefix, self.suffix) = json.dumps(members).split(json.dumps(FEATURES_MARKER), 1)
+        self.f.write(self.prefix + '[')
+
+    def write(self, feature):
+        if self.count:
+            self.f.write(', ')
+        self.f.write(dumpFeature(feature, self.precision))
+        self.count += 1
+
+    def close(self, footer=[]):
+        self.f.write(']')
+        for key, value in footer:
+            self.f.write(', %s: %s' % (json.dumps(key), json.dumps(value)))
+        self.f.write(self.suffix)
+
+# coordinates of a progressive geometry keeping only vertices whose threshold is at least threshold;
+#   thresholds mirror the nesting of coordinates and endpoints (null) are always kept
+def filterByThreshold(coordinates, thresholds, threshold):
+    # this is a line
+    if not thresholds or not isinstance(thresholds[0], list):
+        return [point for (point, t) in zip(coordinates, thresholds) if t is None or t >= threshold]
+
+    # this is an array of lines
+    return [filterByThreshold(c, t, threshold) for (c, t) in zip(coordinates, thresholds)]
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+# Description: converts a geojson file once into a columnar binary copy next to it, so later
+#   runs memory-map its coordinates instead of parsing json. The copy is a directory of .npy
+#   arrays (coordinates, and offsets of paths, parts and features), a small json file of
+#   everything else and one json file per property, read only when that property is used.
+#   It is rebuilt whenever the hash of the geojson file changes
+# Example usage:
+#   table = openGeometry("data/nycparks_simplified_0.1.geojson")
+#   table.coords[table.pathOffsets[0]:table.pathOffsets[1]]
+#   for feature in table: ...
+
+from array import array
+from collections import OrderedDict
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+from geojsonstream import FeatureReader
+
+# bump when the layout changes, so old copies are rebuilt
+VERSION = 1
+# features built at a time when iterating
+ITER_BATCH = 1000
+META_FILE = 'meta.json'
+EXTRAS_FILE = 'extras.json'
+COLUMN_FILE = 'column_%s.json'
+
+# hash of a file's contents
+def fileHash(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# directory the binary copy of a geojson file goes in
+def geometryDir(filename):
+    return filename + '.geometry'
+
+# how deep coordinates are nested: 0 for a point, 1 for a line, 2 for lines or a polygon,
+#   3 for polygons
+def nestingDepth(coordinates):
+    depth = 0
+    while isinstance(coordinates[0], list):
+        coordinates = coordinates[0]
+        depth += 1
+    return depth
+
+# size and modification time of a file
+def fileStat(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime]
+
+# the binary copy of a geojson file, converting it first if it is missing or stale
+def openGeometry(filename, inputHash=None):
+    directory = geometryDir(filename)
+    metaFile = os.path.join(directory, META_FILE)
+    if os.path.isfile(metaFile):
+        table = GeometryTable(directory)
+        if table.meta['version'] == VERSION:
+            # the file is only hashed again once its size or modification time change
+            if table.meta['stat'] == fileStat(filename):
+                return table
+            inputHash = inputHash or fileHash(filename)
+            if table.meta['hash'] == inputHash:
+                table.meta['stat'] = fileStat(filename)
+                with open(metaFile, 'w') as f:
+                    json.dump(table.meta, f)
+                return table
+        print "Rebuilding stale geometry cache %s" % directory
+    convertGeometry(filename, directory, inputHash or fileHash(filename))
+    return GeometryTable(directory)
+
+# write the binary copy of a geojson file to directory
+def convertGeometry(filename, directory, inputHash):
+    coords = array('d')
+    thresholds = array('d')
+    pathOffsets = array('l', [0])
+    partOffsets = array('l', [0])
+    featureOffsets = array('l', [0])
+    depths = array('l')
+    # keys of each feature and its geometry in the order the file has them, so features are
+    #   rebuilt exactly as json.load would build them; each distinct layout is stored once
+    layouts = []
+    layoutIndex = {}
+    featureLayouts = []
+    # members of each feature and geometry other than geometry, properties, coordinates and thresholds
+    extras = []
+    # properties as a column of values per key (None where a feature doesn't have it), with
+    #   the keys of each feature, in order, as one of the distinct sets of keys
+    #   (-1 for features whose properties are null)
+    propertyKeys = []
+    keyIndex = {}
+    featureKeys = []
+    columns = OrderedDict()
+    hasThresholds = False
+    with open(filename) as f:
+        reader = FeatureReader(f, objectPairsHook=OrderedDict)
+        for feature in reader:
+            geometry = feature['geometry']
+            coordinates = geometry['coordinates']
+            featureThresholds = geometry.get('thresholds')
+            hasThresholds = hasThresholds or featureThresholds is not None
+            depth = nestingDepth(coordinates)
+            # everything as a list of parts, each a list of paths
+            parts = [[[coordinates]], [[coordinates]], [coordinates], coordinates][depth]
+            partThresholds = [[[[featureThresholds]]], [[featureThresholds]], [featureThresholds], featureThresholds][depth] if featureThresholds is not None else None
+            for (p, part) in enumerate(parts):
+                for (q, path) in enumerate(part):
+                    for point in path:
+                        coords.append(point[0])
+                        coords.append(point[1])
+                    if partThresholds is not None:
+                        pathThresholds = partThresholds[p][q]
+                        thresholds.extend([np.nan if t is None else t for t in pathThresholds])
+                    else:
+                        thresholds.extend([np.nan] * len(path))
+                    pathOffsets.append(len(coords) // 2)
+                partOffsets.append(len(pathOffsets) - 1)
+            featureOffsets.append(len(partOffsets) - 1)
+            depths.append(depth)
+            layout = (tuple(feature.keys()), tuple(geometry.keys()))
+            if layout not in layoutIndex:
+                layoutIndex[layout] = len(layouts)
+                layouts.append(layout)
+            featureLayouts.append(layoutIndex[layout])
+            extras.append([
+                OrderedDict([(key, value) for (key, value) in feature.items() if key not in ('geometry', 'properties')]),
+                OrderedDict([(key, value) for (key, value) in geometry.items() if key not in ('coordinates', 'thresholds')])
+            ])
+            properties = feature['properties'] or {}
+            keys = tuple(properties.keys())
+            if feature['properties'] is None:
+                featureKeys.append(-1)
+            else:
+                if keys not in keyIndex:
+                    keyIndex[keys] = len(propertyKeys)
+                    propertyKeys.append(list(keys))
+                featureKeys.append(keyIndex[keys])
+            for key in keys:
+                if key not in columns:
+                    columns[key] = [None] * (len(featureKeys) - 1)
+            for (key, column) in columns.items():
+                column.append(properties.get(key))
+        (header, footer) = (reader.header, reader.footer)
+
+    # write next to the final directory and swap it in whole
+    tmpDirectory = directory + '.tmp'
+    if os.path.isdir(tmpDirectory):
+        shutil.rmtree(tmpDirectory)
+    os.makedirs(tmpDirectory)
+    np.save(os.path.join(tmpDirectory, 'coords.npy'), np.frombuffer(coords, dtype=float).reshape(-1, 2))
+    np.save(os.path.join(tmpDirectory, 'paths.npy'), np.frombuffer(pathOffsets, dtype=np.int_))
+    np.save(os.path.join(tmpDirectory, 'parts.npy'), np.frombuffer(partOffsets, dtype=np.int_))
+    np.save(os.path.join(tmpDirectory, 'features.npy'), np.frombuffer(featureOffsets, dtype=np.int_))
+    np.save(os.path.join(tmpDirectory, 'depths.npy'), np.frombuffer(depths, dtype=np.int_))
+    np.save(os.path.join(tmpDirectory, 'layouts.npy'), np.array(featureLayouts, dtype=np.int_))
+    np.save(os.path.join(tmpDirectory, 'keys.npy'), np.array(featureKeys, dtype=np.int_))
+    if hasThresholds:
+        np.save(os.path.join(tmpDirectory, 'thresholds.npy'), np.frombuffer(thresholds, dtype=float))
+    with open(os.path.join(tmpDirectory, EXTRAS_FILE), 'w') as f:
+        json.dump(extras, f)
+    for (i, column) in enumerate(columns.values()):
+        with open(os.path.join(tmpDirectory, COLUMN_FILE % i), 'w') as f:
+            json.dump(column, f)
+    meta = {
+        "version": VERSION,
+        "hash": inputHash,
+        "stat": fileStat(filename),
+        "header": header,
+        "footer": footer,
+        "layouts": layouts,
+        "propertyKeys": propertyKeys,
+        "columns": columns.keys()
+    }
+    with open(os.path.join(tmpDirectory, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.rename(tmpDirectory, directory)
+    print "Saved geometry of %s features (%s points) to %s" % (len(depths), len(coords) // 2, directory)
+
+class GeometryTable(object):
+
+    # arrays are memory-mapped, read from disk only as they are used
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.header = [tuple(member) for member in self.meta['header']]
+        self.footer = [tuple(member) for member in self.meta['footer']]
+        self.coords = self.load('coords.npy')
+        self.pathOffsets = self.load('paths.npy')
+        self.partOffsets = self.load('parts.npy')
+        self.featureOffsets = self.load('features.npy')
+        self.depths = self.load('depths.npy')
+        self.featureLayouts = self.load('layouts.npy')
+        self.featureKeys = self.load('keys.npy')
+        # NaN where a vertex has no threshold (endpoints), None if no feature has thresholds
+        self.thresholds = self.load('thresholds.npy') if os.path.isfile(os.path.join(directory, 'thresholds.npy')) else None
+        # read as they are needed
+        self.columns = {}
+        self.extras = None
+        self.rows = None
+
+    def load(self, name):
+        return np.load(os.path.join(self.directory, name), mmap_mode='r')
+
+    # value of a property for every feature, None where a feature doesn't have it
+    def column(self, key):
+        if key not in self.columns:
+            if key not in self.meta['columns']:
+                raise KeyError(key)
+            with open(os.path.join(self.directory, COLUMN_FILE % self.meta['columns'].index(key))) as f:
+                self.columns[key] = json.load(f)
+        return self.columns[key]
+
+    # properties of every feature, as json.load would build them
+    def properties(self):
+        if self.rows is None:
+            columns = [self.column(key) for key in self.meta['columns']]
+            columnIndex = dict([(key, i) for (i, key) in enumerate(self.meta['columns'])])
+            keyColumns = [[(key, columns[columnIndex[key]]) for key in keys] for keys in self.meta['propertyKeys']]
+            self.rows = []
+            for (i, k) in enumerate(self.featureKeys.tolist()):
+                if k < 0:
+                    self.rows.append(None)
+                    continue
+                properties = {}
+                for (key, column) in keyColumns[k]:
+                    properties[key] = column[i]
+                self.rows.append(properties)
+        return self.rows
+
+    def __len__(self):
+        return len(self.depths)
+
+    # number of paths in each feature
+    def featurePathCounts(self):
+        return np.diff(np.asarray(self.partOffsets)[self.featureOffsets])
+
+    # points of the paths of features start to end back to back, a view of the memory map, and
+    #   the offset where each path starts
+    def lines(self, start, end):
+        (first, last) = self.partOffsets[self.featureOffsets[[start, end]]]
+        offsets = np.asarray(self.pathOffsets[first:last+1])
+        return (self.coords[offsets[0]:offsets[-1]], offsets - offsets[0])
+
+    # nested coordinates of features start to end as geojson has them, from a list per path
+    def nest(self, start, end, paths):
+        paths = iter(paths)
+        featureOffsets = self.featureOffsets[start:end+1].tolist()
+        partOffsets = self.partOffsets[featureOffsets[0]:featureOffsets[-1]+1].tolist()
+        partOffsets = [offset - partOffsets[0] for offset in partOffsets]
+        featureOffsets = [offset - featureOffsets[0] for offset in featureOffsets]
+        nested = []
+        for (i, depth) in enumerate(self.depths[start:end].tolist()):
+            parts = []
+            for part in range(featureOffsets[i], featureOffsets[i+1]):
+                parts.append([next(paths) for path in range(partOffsets[part], partOffsets[part+1])])
+            nested.append([parts[0][0][0], parts[0][0], parts[0], parts][depth])
+        return nested
+
+    # nested coordinates and thresholds (None if there are none) of features start to end, as
+    #   geojson has them, as lists made from just their slice of the memory map
+    def coordinates(self, start, end):
+        (points, offsets) = self.lines(start, end)
+        first = self.pathOffsets[self.partOffsets[self.featureOffsets[start]]]
+        nested = []
+        for values in [points, self.thresholds[first:first+len(points)] if self.thresholds is not None else None]:
+            if values is None:
+                nested.append([None] * (end - start))
+                continue
+            if values.ndim == 1:
+                values = np.where(np.isnan(values), None, values)
+            values = values.tolist()
+            nested.append(self.nest(start, end, [values[c:d] for (c, d) in zip(offsets[:-1], offsets[1:])]))
+        return nested
+
+    # features start to end as json.load would build them; without coordinates, their coordinates
+    #   and thresholds are None, to be set before they are written
+    def features(self, start, end, coordinates=True):
+        if self.extras is None:
+            with open(os.path.join(self.directory, EXTRAS_FILE)) as f:
+                self.extras = json.load(f)
+        properties = self.properties()
+        if coordinates:
+            (nestedCoordinates, nestedThresholds) = self.coordinates(start, end)
+        else:
+            nestedCoordinates = nestedThresholds = [None] * (end - start)
+        features = []
+        for (i, layout) in enumerate(self.featureLayouts[start:end].tolist()):
+            (featureKeys, geometryKeys) = self.meta['layouts'][layout]
+            (featureExtras, geometryExtras) = self.extras[start + i]
+            # insert members in the order the file had them
+            geometry = {}
+            for key in geometryKeys:
+                geometry[key] = nestedCoordinates[i] if key == 'coordinates' else nestedThresholds[i] if key == 'thresholds' else geometryExtras[key]
+            feature = {}
+            for key in featureKeys:
+                feature[key] = geometry if key == 'geometry' else properties[start + i] if key == 'properties' else featureExtras[key]
+            features.append(feature)
+        return features
+
+    def feature(self, i):
+        return self.features(i, i + 1)[0]
+
+    def __iter__(self):
+        for start in range(0, len(self), ITER_BATCH):
+            for feature in self.features(start, min(start + ITER_BATCH, len(self))):
+                yield feature
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Description: wall time and counters of the named stages of a run, written as json; with
+#   profiling on, every stage also runs under its own cProfile profiler and the stats of the
+#   stage that took longest are saved
+# Example usage:
+#   stages = Stages(profile=True)
+#   with stages.stage("load"):
+#       features = load()
+#   stages.count("load", features=len(features))
+#   stages.save("stages.json")
+
+import cProfile
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import pstats
+import time
+
+# lines of the hottest stage's profile to print
+PROFILE_LINES = 15
+
+class Stages(object):
+
+    def __init__(self, profile=False):
+        self.profile = profile
+        # name => {"seconds", "calls", and any counters}, in the order stages first ran
+        self.stages = OrderedDict()
+        self.profilers = {}
+
+    def get(self, name):
+        if name not in self.stages:
+            self.stages[name] = OrderedDict([("seconds", 0.0), ("calls", 0)])
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        record = self.get(name)
+        profiler = None
+        if self.profile:
+            profiler = self.profilers.setdefault(name, cProfile.Profile())
+            profiler.enable()
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record["seconds"] += time.time() - start
+            record["calls"] += 1
+            if profiler:
+                profiler.disable()
+
+    # items of an iterable, timing how long each takes to come under name
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    # add to counters of a stage, such as verticesIn, verticesOut, culled or bytes
+    def count(self, name, **counters):
+        record = self.get(name)
+        for (key, value) in sorted(counters.items()):
+            record[key] = record.get(key, 0) + value
+
+    def hottest(self):
+        if not self.stages:
+            return None
+        return max(self.stages, key=lambda name: self.stages[name]["seconds"])
+
+    def report(self):
+        return {
+            "seconds": sum([record["seconds"] for record in self.stages.values()]),
+            "stages": self.stages
+        }
+
+    # write the report as json, and the profile of the hottest stage next to it
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        print "Saved stage timings to %s" % filename
+        hottest = self.hottest()
+        if self.profile and hottest in self.profilers:
+            profileFile = filename + '.prof'
+            self.profilers[hottest].dump_stats(profileFile)
+            print "Saved profile of the slowest stage, %s (%.3fs), to %s" % (hottest, self.stages[hottest]["seconds"], profileFile)
+            pstats.Stats(profileFile).sort_stats('cumulative').print_stats(PROFILE_LINES)
@@ -36,6 +36,12 @@ SOFTWARE.
 ================================
 '''
 
+from array import array as typed_array
+from heapq import heapify, heappush, heappop
+from json import loads
+from math import sqrt
+import re
+from string import maketrans
 from numpy import array, argmin
 import numpy as np
 
@@ -92,15 +98,211 @@ def remove(s,i):
     '''
     s[i:-1]=s[i+1:]
 
+def ragged_triangle_areas(pts,offsets):
+    '''
+    take an (N,2) array holding several lines back to back, where
+    line k is pts[offsets[k]:offsets[k+1]], and return the (N,)
+    array of triangle areas of every line in one vectorized pass.
+    the first and last area of each line are np.inf, so every
+    slice matches triangle_areas_from_array of that line alone.
+    '''
+    offsets = np.asarray(offsets)
+    if len(pts) < 3:
+        return np.full((len(pts),),np.inf)
+    #triangles that straddle two lines only ever land on endpoints,
+    # which are overwritten below
+    result = triangle_areas_from_array(pts)
+    starts = offsets[:-1]
+    ends = offsets[1:]
+    nonempty = ends > starts
+    result[starts[nonempty]] = np.inf
+    result[ends[nonempty]-1] = np.inf
+    return result
+
+def heap_thresholds(pts,areas,offsets=None):
+    '''
+    take an (N,2) array of points and their initial triangle
+    areas (see triangle_areas_from_array) and return the effective
+    area of every vertex, in place in areas.
+
+    vertices are kept in a doubly linked list (prev/nxt) and the
+    smallest area is found with a heap, so this is O(n log n)
+    rather than the O(n^2) argmin/remove loop.  Stale heap entries
+    are skipped lazily.  Ties and the monotonic "effective area"
+    rule are resolved exactly as in VWSimplifier.build_thresholds_reference,
+    so both give identical results.
+
+    if offsets are given, pts holds several lines back to back (see
+    ragged_triangle_areas) and each one is processed on its own.  The
+    linked list and coordinate lists are shared by all of them, so
+    nothing but the heap is allocated per line.  they are typed arrays
+    rather than lists, 8 bytes a vertex each instead of a python
+    object per vertex, which is also a little faster to index.
+    '''
+    n = len(pts)
+    if offsets is None:
+        offsets = [0,n]
+    else:
+        offsets = np.asarray(offsets).tolist()
+    xs = typed_array('d',np.ascontiguousarray(pts[:,0],dtype=float).tobytes())
+    ys = typed_array('d',np.ascontiguousarray(pts[:,1],dtype=float).tobytes())
+    cur = typed_array('d',np.asarray(areas,dtype=float).tobytes())
+    inf = np.inf
+    prev = typed_array('l',np.arange(-1,n-1,dtype=np.int_).tobytes())
+    nxt = typed_array('l',np.arange(1,n+1,dtype=np.int_).tobytes())
+    removed = typed_array('b',bytes(bytearray(n)))
+
+    for lo, hi in zip(offsets[:-1],offsets[1:]):
+        if hi-lo < 3:
+            continue
+        #cut the linked list at the ends of this line
+        prev[lo] = -1
+        nxt[hi-1] = -1
+
+        heap = [(cur[k],k) for k in xrange(lo+1,hi-1)]
+        heapify(heap)
+
+        this_area, k = heappop(heap)
+        while this_area < inf:
+            l = prev[k]; r = nxt[k]
+            nxt[l] = r; prev[r] = l
+            removed[k] = True
+            skip = -1
+
+            #right neighbor, unless it is the last endpoint
+            rr = nxt[r]
+            if rr >= 0:
+                a = abs(xs[l]*(ys[r]-ys[rr])+xs[r]*(ys[rr]-ys[l])+xs[rr]*(ys[l]-ys[r]))/2.
+                if a <= this_area:
+                    #not more significant than the point just removed
+                    a = this_area
+                    skip = r
+                cur[r] = a
+                heappush(heap,(a,r))
+
+            #left neighbor, unless it is the first endpoint
+            ll = prev[l]
+            if ll >= 0:
+                a = abs(xs[ll]*(ys[l]-ys[r])+xs[l]*(ys[r]-ys[ll])+xs[r]*(ys[ll]-ys[l]))/2.
+                if a <= this_area:
+                    a = this_area
+                    skip = l
+                cur[l] = a
+                heappush(heap,(a,l))
+
+            if skip >= 0:
+                k = skip
+                continue
+
+            #pop until we find an entry that is still current
+            while heap:
+                this_area, k = heappop(heap)
+                if not removed[k] and cur[k] == this_area:
+                    break
+            else:
+                break
+
+    areas[:] = np.frombuffer(cur,dtype=float)
+    return areas
+
+#dp_thresholds splits ranges of this many points or fewer in plain
+# python, as numpy costs more than it saves on them
+SMALL_RANGE = 16
+
+def point_segment_distance(xs,ys,i,j,k):
+    '''distance from point i to the segment from point j to point k,
+    given lists of x and y coordinates'''
+    x, y = xs[i]-xs[j], ys[i]-ys[j]
+    dx, dy = xs[k]-xs[j], ys[k]-ys[j]
+    length = dx*dx + dy*dy
+    if length > 0:
+        t = min(max((x*dx + y*dy) / length,0.),1.)
+        x, y = x - t*dx, y - t*dy
+    return sqrt(x*x + y*y)
+
+def dp_thresholds(pts,offsets=None):
+    '''
+    take an (N,2) array of points and return the Douglas-Peucker
+    distance of every vertex: the tolerance up to which Douglas-
+    Peucker keeps it.  endpoints are np.inf.
+
+    ranges still to split are kept on a stack rather than recursed
+    into, and the distances from all points inside a range to the
+    segment joining its ends are computed at once with numpy.  a
+    vertex is never given more than the vertex that split the range
+    it is in, so keeping the points at or above a threshold gives
+    what Douglas-Peucker gives at that tolerance.
+
+    if offsets are given, pts holds several lines back to back (see
+    ragged_triangle_areas) and each one is processed on its own.
+    '''
+    pts = np.asarray(pts,dtype=float)
+    n = len(pts)
+    if offsets is None:
+        offsets = [0,n]
+    else:
+        offsets = np.asarray(offsets).tolist()
+    result = np.zeros((n,))
+    stack = []
+    for lo, hi in zip(offsets[:-1],offsets[1:]):
+        if hi > lo:
+            result[lo] = np.inf
+            result[hi-1] = np.inf
+        if hi-lo > 2:
+            stack.append((lo,hi-1,np.inf))
+
+    xs = pts[:,0].tolist()
+    ys = pts[:,1].tolist()
+    while stack:
+        lo, hi, cap = stack.pop()
+        if hi-lo <= SMALL_RANGE:
+            dist = [point_segment_distance(xs,ys,i,lo,hi) for i in range(lo+1,hi)]
+            dk = max(dist)
+            k = dist.index(dk)
+        else:
+            a = pts[lo]
+            d = pts[hi] - a
+            rel = pts[lo+1:hi] - a
+            length = d[0]*d[0] + d[1]*d[1]
+            if length > 0:
+                #distance to the nearest point of the segment, which is the
+                # perpendicular distance wherever the foot falls on it
+                t = rel.dot(d) / length
+                np.clip(t,0.,1.,out=t)
+                rel -= t[:,None]*d
+            dist = rel[:,0]*rel[:,0] + rel[:,1]*rel[:,1]
+            k = int(dist.argmax())
+            dk = np.sqrt(dist[k])
+        dk = min(dk,cap)
+        k += lo+1
+        result[k] = dk
+        if k-lo > 1:
+            stack.append((lo,k,dk))
+        if hi-k > 1:
+            stack.append((k,hi,dk))
+    return result
+
 class VWSimplifier(object):
+    __slots__ = ('pts','thresholds','ordered_thresholds')
 
-    def __init__(self,pts):
+    def __init__(self,pts,compact=False,dtype=None):
         '''Initialize with points. takes some time to build
         the thresholds but then all threshold filtering later
-        is ultra fast'''
-        self.pts = np.array(pts)
-        self.thresholds = self.build_thresholds()
-        self.ordered_thresholds = sorted(self.thresholds,reverse=True)
+        is ultra fast.
+
+        compact is for keeping simplifiers of millions of points
+        around: pts is kept as given rather than copied, and the
+        thresholds aren't also kept sorted, so from_number selects
+        its threshold with np.partition on every call.  dtype stores
+        the thresholds as, say, np.float32 to halve them; points
+        within float32 rounding of each other may then tie.'''
+        self.pts = np.asarray(pts) if compact else np.array(pts)
+        thresholds = self.build_thresholds()
+        self.thresholds = thresholds.astype(dtype) if dtype else thresholds
+        if compact:
+            self.ordered_thresholds = None
+        else:
+            self.ordered_thresholds = np.sort(self.thresholds)[::-1]
 
     def build_thresholds(self):
         '''compute the area value of each vertex, which one would
@@ -108,6 +310,13 @@ class VWSimplifier(object):
 
         returns a numpy.array (length of pts)  of the areas.
         '''
+        return heap_thresholds(self.pts,triangle_areas_from_array(self.pts))
+
+    def build_thresholds_reference(self):
+        '''original O(n^2) argmin/remove implementation of
+        build_thresholds, kept as a reference to check the heap
+        version against.
+        '''
         pts = self.pts
         nmax = len(pts)
         real_areas = triangle_areas_from_array(pts)
@@ -193,11 +402,24 @@ class VWSimplifier(object):
     def from_threshold(self,threshold):
         return self.pts[self.thresholds >= threshold]
 
+    def threshold_from_number(self,n):
+        '''the n-th highest threshold, counting from 0, above which
+        from_number(n) keeps points; None if n is past the end and
+        every point is kept'''
+        size = len(self.thresholds)
+        n = int(n)
+        if n < 0:
+          n += size
+        if n < 0 or n >= size:
+          return None
+        if self.ordered_thresholds is not None:
+          return self.ordered_thresholds[n]
+        k = size-1-n
+        return np.partition(self.thresholds,k)[k]
+
     def from_number(self,n):
-        thresholds = self.ordered_thresholds
-        try:
-          threshold = thresholds[int(n)]
-        except IndexError:
+        threshold = self.threshold_from_number(n)
+        if threshold is None:
           return self.pts
         return self.pts[self.thresholds > threshold]
 
@@ -207,9 +429,175 @@ class VWSimplifier(object):
         else:
           return self.from_number(r*len(self.thresholds))
 
+class DPSimplifier(VWSimplifier):
+    '''Douglas-Peucker instead of Visvalingam-Whyatt: thresholds
+    are distances, in the units of pts, rather than areas.  the
+    filtering methods are the same'''
+    __slots__ = ()
+
+    def build_thresholds(self):
+        return dp_thresholds(self.pts)
+
+class VWBatchSimplifier(object):
+
+    def __init__(self,pts,offsets,thresholds=None):
+        '''Initialize with many lines at once: an (N,2) array of
+        points holding every line back to back, and offsets such that
+        line k is pts[offsets[k]:offsets[k+1]].  Thresholds are the
+        same as a VWSimplifier per line would give, but the triangle
+        areas are computed in one pass and no per line objects are
+        created.  Results are boolean masks over pts.
+
+        pass thresholds saved from an earlier run to skip building
+        them; pts may then be None if only masks are needed.'''
+        self.offsets = np.asarray(offsets,dtype=np.intp)
+        self.lengths = np.diff(self.offsets)
+        if pts is not None:
+          self.pts = np.asarray(pts,dtype=float)
+        else:
+          self.pts = None
+        if thresholds is not None:
+          self.thresholds = np.asarray(thresholds)
+        else:
+          self.thresholds = self.build_thresholds()
+        self.ordered_thresholds = None
+
+    def build_thresholds(self):
+        areas = ragged_triangle_areas(self.pts,self.offsets)
+        return heap_thresholds(self.pts,areas,self.offsets)
+
+    def line_ids(self):
+        '''index of the line each point belongs to'''
+        return np.repeat(np.arange(len(self.lengths)),self.lengths)
+
+    def order(self):
+        '''thresholds sorted in descending order within each line,
+        laid out like pts.  built once, on first use.'''
+        if self.ordered_thresholds is None:
+            ids = self.line_ids()
+            idx = np.lexsort((-self.thresholds,ids))
+            self.ordered_thresholds = self.thresholds[idx]
+        return self.ordered_thresholds
+
+    def mask_from_threshold(self,threshold):
+        return self.thresholds >= threshold
+
+    def mask_from_number(self,n):
+        '''n is a number of points per line, or one number for
+        all of them.  same semantics as VWSimplifier.from_number'''
+        lengths = self.lengths
+        if not len(self.thresholds):
+          return np.zeros((0,),bool)
+        n = np.broadcast_to(np.asarray(n).astype(np.intp),lengths.shape)
+        #negative n counts back from the end of each line
+        n = np.where(n < 0,n + lengths,n)
+        #lines asking for all their points (or past the start) keep everything
+        keep_all = (n >= lengths) | (n < 0)
+        ordered = self.order()
+        pos = np.minimum(self.offsets[:-1] + np.where(keep_all,0,n),len(ordered)-1)
+        mask = self.thresholds > np.repeat(ordered[pos],lengths)
+        mask[np.repeat(keep_all,lengths)] = True
+        return mask
+
+    def mask_from_ratio(self,r):
+        if r<=0 or r>1:
+          raise ValueError("Ratio must be 0<r<=1")
+        else:
+          return self.mask_from_number(r*self.lengths)
+
+    def threshold_from_budget(self,budget,min_number=0):
+        '''one threshold for every line that keeps about budget
+        points in all: the min_number points per line mask_from_number
+        would keep count first, and the rest of the budget goes to the
+        points with the highest thresholds anywhere.  points tied at
+        the threshold are all kept'''
+        forced = self.mask_from_number(min_number)
+        free = self.thresholds[~forced]
+        extra = int(budget) - int(forced.sum())
+        if extra <= 0:
+          return np.inf
+        if extra >= len(free):
+          return -np.inf
+        k = len(free) - extra
+        return np.partition(free,k)[k]
+
+    def mask_from_budget(self,budget,min_number=0):
+        threshold = self.threshold_from_budget(budget,min_number)
+        return self.mask_from_number(min_number) | self.mask_from_threshold(threshold)
+
+class DPBatchSimplifier(VWBatchSimplifier):
+    '''VWBatchSimplifier with Douglas-Peucker distances as thresholds,
+    see DPSimplifier'''
+
+    def build_thresholds(self):
+        return dp_thresholds(self.pts,self.offsets)
+
+wkt_punctuation = maketrans('(),','   ')
+#where a comma goes between the groups of a WKT skeleton
+wkt_separator = re.compile(r'(?<=[0)])(?=[0(])')
+
+def wkt_points(pts,precision=None):
+    '''
+    take an (N,2) array and return it as a WKT list of points,
+    '(x y,x y,...)', formatting every number in a single operation
+    rather than a point at a time.  numbers are written in full, or
+    rounded to precision decimal places without trailing zeros.
+    '''
+    if not len(pts):
+        return '()'
+    if precision is None:
+        point = '%s %s'
+        flat = tuple(np.asarray(pts,dtype=float).astype(str).ravel().tolist())
+    else:
+        numbers = np.round(pts,precision).ravel() + 0.  #no -0
+        #each number gets as many significant digits as it has before
+        # the point, plus precision, passed in just before it
+        size = np.abs(numbers)
+        size[size < 1] = 1
+        digits = np.minimum(np.floor(np.log10(size)).astype(int) + 1 + precision,17)
+        point = '%.*g %.*g'
+        flat = [None]*(2*len(numbers))
+        flat[::2] = digits.tolist()
+        flat[1::2] = numbers.tolist()
+        flat = tuple(flat)
+    return '(' + ','.join([point]*len(pts)) % flat + ')'
+
+def parse_wkt_points(text):
+    '''
+    take the coordinates of a 2D WKT geometry, such as
+    '((x y,x y,...),(x y,...))', and return each of its lines or rings
+    as an (N,2) array, nested in lists as the parentheses are.  numpy
+    parses every number in one pass, and the parentheses are only used
+    to split them up.
+    '''
+    text = str(text).strip()
+    chars = np.frombuffer(text,dtype=np.uint8)
+    brackets = np.flatnonzero((chars == ord('(')) | (chars == ord(')')))
+    opening = chars[brackets] == ord('(')
+    #a line or ring is a bracket opened and closed with none between
+    groups = np.flatnonzero(opening[:-1] & ~opening[1:])
+    commas = np.concatenate(([0],np.cumsum(chars == ord(','))))
+    counts = commas[brackets[groups+1]] - commas[brackets[groups]] + 1
+    numbers = np.fromstring(text.translate(wkt_punctuation),sep=' ')
+    if len(numbers) != 2*counts.sum():
+      raise ValueError("Expected %s 2D points but read %s numbers"
+                       % (counts.sum(),len(numbers)))
+    lines = iter(np.split(numbers.reshape(-1,2),np.cumsum(counts)[:-1]))
+    #the nesting of the brackets, with each line or ring as 0
+    skeleton = chars[brackets].tostring().replace('()','0')
+    skeleton = wkt_separator.sub(',',skeleton)
+    skeleton = loads(skeleton.replace('(','[').replace(')',']'))
+    def fill(item):
+        if isinstance(item,list):
+            return [fill(sub) for sub in item]
+        return next(lines)
+    return fill(skeleton)
+
 class WKTSimplifier(VWSimplifier):
       '''VWSimplifier that returns strings suitable for WKT
       creation'''
+      __slots__ = ('precision',)
+
       def __init__(self,*args,**kwargs):
          if 'precision' in kwargs:
            p=kwargs.pop('precision')
@@ -219,10 +607,9 @@ class WKTSimplifier(VWSimplifier):
          self.set_precision(p)
 
       def set_precision(self,precision):
-          if precision:
-            self.pts_as_strs = self.pts.astype('S%s'%precision)
-          else:
-            self.pts_as_strs = self.pts.astype(str)
+          '''decimal places coordinates are rounded to, or None
+          to write them in full'''
+          self.precision = precision
 
 
       '''slow
@@ -233,15 +620,12 @@ class WKTSimplifier(VWSimplifier):
       def wkt_from_threshold(self,threshold, precision=None):
           if precision:
             self.set_precision(precision)
-          pts = self.pts_as_strs[self.thresholds >= threshold]
-          return '(%s)'%','.join(['%s %s'%(x,y) for x,y in pts])
+          return wkt_points(self.pts[self.thresholds >= threshold],self.precision)
 
       def wkt_from_number(self,n,precision=None):
-        thresholds = self.ordered_thresholds
         if n<3: n=3  #For polygons. TODO something better
-        try:
-          threshold = thresholds[int(n)]
-        except IndexError:
+        threshold = self.threshold_from_number(n)
+        if threshold is None:
           threshold = 0
 
         return self.wkt_from_threshold(threshold,precision=precision)
@@ -267,9 +651,6 @@ except ImportError:
                   GDALSimplifier not available.
                   """
 else:
-    from json import loads
-    import re
-    p = re.compile( '([ 0123456789.]+) ([0123456789.]+)')
     class GDALSimplifier(object):
       '''Warning, there is a slight loss of precision just in the
       conversion from geometry object to numpy.array even if no
@@ -284,7 +665,6 @@ else:
           VWSimplifiers.  set return_GDAL to False for faster
           filtering with arrays of floats returned instead of
           geometry objects.'''
-          global p
           self.return_GDAL = return_GDAL
           if isinstance(geom,OGRGeometry):
             name = geom.geom_name
@@ -296,15 +676,10 @@ else:
             self.pts = np.array(geom.tuple)
           elif isinstance(geom, unicode) or isinstance(geom,str):
             #assume wkt
-            #for WKT
-            def str2tuple(q):
-                return '(%s,%s)' % (q.group(1),q.group(2))
-
             self.return_GDAL = False #don't even try
             self.Geometry = lambda w: w #this will never be used
             name, pts = geom.split(' ',1)
-            self.pts = loads(p.sub(str2tuple,pts).\
-                             replace('(','[').replace(')',']'))
+            self.pts = parse_wkt_points(pts)
           self.precision = precision
           if name == 'LINESTRING':
             self.maskfunc = self.linemask
@@ -423,6 +798,22 @@ else:
           return self.maskfunc(r)
 
 
+def check_thresholds(lines):
+    '''indices of the lines (arrays of points) whose thresholds from
+    heap_thresholds, one line at a time or all in one batch, differ
+    from build_thresholds_reference; empty if every line matches.
+    benchmark.py runs this before timing anything'''
+    lines = [np.asarray(pts,dtype=float) for pts in lines]
+    references = [VWSimplifier(pts).build_thresholds_reference() for pts in lines]
+    offsets = np.concatenate(([0],np.cumsum([len(pts) for pts in lines]))).astype(np.intp)
+    batch = VWBatchSimplifier(np.concatenate(lines),offsets).thresholds
+    mismatches = []
+    for (k,(pts,reference)) in enumerate(zip(lines,references)):
+        if not np.array_equal(VWSimplifier(pts).thresholds,reference) or \
+           not np.array_equal(batch[offsets[k]:offsets[k+1]],reference):
+            mismatches.append(k)
+    return mismatches
+
 def fancy_parametric(k):
     ''' good k's: .33,.5,.65,.7,1.3,1.4,1.9,3,4,5'''
     cos = np.cos
@@ -444,10 +835,22 @@ if __name__ == "__main__":
    end = time()
    print "%s vertices removed in %02f seconds"%(n-len(pts), end-start)
 
-   import matplotlib
-   matplotlib.use('AGG')
-   import matplotlib.pyplot as plot
-   plot.plot(pts[:,0],pts[:,1],color='r')
-   plot.savefig('visvalingam.png')
-   print "saved visvalingam.png"
+   start = time()
+   mismatches = check_thresholds([simplifier.pts])
+   end = time()
+   if mismatches:
+     raise SystemExit("heap thresholds differ from the reference")
+   print "reference thresholds match, checked in %02f seconds"%(end-start)
+
+   #plotting is optional, benchmark.py times the same curve without it
+   try:
+     import matplotlib
+   except ImportError:
+     matplotlib = None
+   if matplotlib:
+     matplotlib.use('AGG')
+     import matplotlib.pyplot as plot
+     plot.plot(pts[:,0],pts[:,1],color='r')
+     plot.savefig('visvalingam.png')
+     print "saved visvalingam.png"
    #plot.show()
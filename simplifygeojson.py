@@ -4,64 +4,536 @@
 # Example usage:
 #   python simplifygeojson.py -if data/nycsubway.geojson -of data/nycsubway_simplified_%s.geojson -r 0.1 -mp 10
 #   python simplifygeojson.py -if data/nycboroughs.geojson -of data/nycboroughs_simplified_%s.geojson -r 0.3
-#   python simplifygeojson.py -if data/nycparks.geojson -of data/nycparks_simplified_%s.geojson -r 0.1
+#   python simplifygeojson.py -if data/nycparks.geojson -of data/nycparks_simplified_%s.geojson -r 0.1 -j 4
+#   python simplifygeojson.py -if data/nycparks.geojson -of data/nycparks_simplified_%s.geojson -r 0.1,0.2,0.3 -c
+#   python simplifygeojson.py -if data/nycsubway.geojson -of data/nycsubway_simplified_%s.geojson -pg
+#   python simplifygeojson.py -if data/nycboroughs.geojson -of data/nycboroughs_simplified_%s.geojson -r 0.3 -t
+#   python simplifygeojson.py -if data/nycparks.geojson -of data/nycparks_simplified_%s.geojson -r 0.1,0.2,0.3 -gc
+#   python simplifygeojson.py -if data/nycparks.geojson -of data/nycparks_simplified_%s.geojson -r 0.1 -p 6
+#   python simplifygeojson.py -if data/nycparks.geojson -of data/nycparks_simplified_%s.geojson -tb 500000 -p 6
+#   python simplifygeojson.py -if data/nycsubway.geojson -of data/nycsubway_simplified_%s.geojson -a dp -tol 1
 
 import argparse
 import json
-from polysimplify import VWSimplifier
+from multiprocessing import Pool
+import numpy as np
+import os
+import time
+from geojsonstream import FeatureReader, FeatureWriter, dumpFeature, formatCoordinates
+from geometrycache import fileHash, openGeometry
+from instrument import Stages
+from polysimplify import DPBatchSimplifier, VWBatchSimplifier
+from spatialindex import metricPoints
+from topology import buildArcs, joinArcs
 
 # input
 parser = argparse.ArgumentParser()
 parser.add_argument('-if', dest="INPUT_FILE", default="data/nycsubway.geojson", help="Path to input geojson file")
 parser.add_argument('-of', dest="OUTPUT_FILE", default="data/nycsubway_simplified_%s.geojson", help="Path to output geojson file")
-parser.add_argument('-r', dest="SIMPLIFY_PERCENT", default="0.1", type=float, help="Target percent of points from existing points")
-parser.add_argument('-mp', dest="MIN_POINTS", default="10", type=int, help="Minimum number of points")
+parser.add_argument('-r', dest="SIMPLIFY_PERCENT", default="0.1", help="Target percent of points from existing points; a comma-separated list writes one file per percent")
+parser.add_argument('-vb', dest="VERTEX_BUDGET", default=None, type=int, help="Instead of a percent per line, keep this many points in all, dropping the least significant points of the whole file first")
+parser.add_argument('-tb', dest="TARGET_BYTES", default=None, type=int, help="Instead of a percent per line, keep as many points as fit in a file of about this many bytes, dropping the least significant points of the whole file first")
+parser.add_argument('-tol', dest="TOLERANCE", default=None, type=float, help="Instead of a percent per line, keep every point further than this many meters from the simplified line (needs -a dp)")
+parser.add_argument('-mp', dest="MIN_POINTS", default=None, type=int, help="Minimum number of points (10, or 4 with a budget or tolerance)")
+parser.add_argument('-a', '--algorithm', dest="ALGORITHM", default="vw", choices=["vw", "dp"], help="Rank points by Visvalingam-Whyatt area (vw) or by Douglas-Peucker distance in meters (dp)")
+parser.add_argument('-j', '--jobs', dest="JOBS", default="1", type=int, help="Number of worker processes")
+parser.add_argument('-s', '--stream', dest="STREAM", action="store_true", help="Read, simplify and write features incrementally to keep memory flat")
+parser.add_argument('-bs', dest="BATCH_SIZE", default="500", type=int, help="Number of features simplified at a time when streaming")
+parser.add_argument('-pg', '--progressive', dest="PROGRESSIVE", action="store_true", help="Also write all points tagged with their thresholds, so any level of detail can be read from one file")
+parser.add_argument('-t', '--topology', dest="TOPOLOGY", action="store_true", help="Split lines into shared arcs and simplify each arc once, so shared boundaries stay seamless")
+parser.add_argument('-p', '--precision', dest="PRECISION", default=None, type=int, help="Round coordinates to this many decimal places (e.g. 6), dropping vertices that become duplicates, and write them with a bulk formatter")
+parser.add_argument('-ss', dest="STATS_FILE", default=None, help="Write the time and vertices in and out of each stage, and bytes written, to this json file")
+parser.add_argument('-pf', '--profile', dest="PROFILE", action="store_true", help="Also profile each stage with cProfile and save the slowest stage's stats next to the stats file")
+parser.add_argument('-c', '--cache', dest="CACHE", action="store_true", help="Reuse thresholds saved next to the input file (keyed by its content hash) instead of rebuilding them")
+parser.add_argument('-gc', '--geometry-cache', dest="GEOMETRY_CACHE", action="store_true", help="Read features from a memory-mapped binary copy of the input file, made next to it on first use and whenever it changes")
 
 # init input
 args = parser.parse_args()
-MIN_POINTS = args.MIN_POINTS
+if args.TOPOLOGY and args.STREAM:
+    parser.error("--topology needs every feature at once and can't be combined with --stream")
+if args.VERTEX_BUDGET is not None and args.TARGET_BYTES is not None:
+    parser.error("-vb and -tb can't be combined")
+BUDGET_MODE = args.VERTEX_BUDGET is not None or args.TARGET_BYTES is not None
+if BUDGET_MODE and args.STREAM:
+    parser.error("a budget for the whole file needs every feature at once and can't be combined with --stream")
+TOLERANCE_MODE = args.TOLERANCE is not None
+if TOLERANCE_MODE and args.ALGORITHM != "dp":
+    parser.error("-tol is a distance, so it needs Douglas-Peucker thresholds (-a dp)")
+if TOLERANCE_MODE and BUDGET_MODE:
+    parser.error("-tol can't be combined with -vb or -tb")
+# with a budget or tolerance, small lines only keep enough points to stay rings so points go where they matter most
+MIN_POINTS = args.MIN_POINTS if args.MIN_POINTS is not None else 4 if BUDGET_MODE or TOLERANCE_MODE else 10
+PRECISION = args.PRECISION
+# one output per percent, or a single one at the budget or tolerance
+if BUDGET_MODE:
+    LEVELS = ['%sv' % args.VERTEX_BUDGET if args.VERTEX_BUDGET is not None else '%sb' % args.TARGET_BYTES]
+elif TOLERANCE_MODE:
+    LEVELS = ['%gm' % args.TOLERANCE]
+else:
+    LEVELS = [float(percent) for percent in args.SIMPLIFY_PERCENT.split(',')]
 
-# read geojson file
-geojson = {}
-with open(args.INPUT_FILE) as f:
-    geojson = json.load(f)
-
-# simplify a line
-def simplify(line, percent):
-    global MIN_POINTS
-    lineLen = len(line)
-    minLen = min([MIN_POINTS, lineLen])
-    simplifier = VWSimplifier(line)
-    targetLen = max([int(round(lineLen*percent)), minLen])
-    simplified = simplifier.from_number(targetLen)
-    return simplified.tolist()
-
-# recursively simplify arr of lines
-def simplifyRecursive(arr, percent):
+# collect every line of arr, in order
+def flattenRecursive(arr, lines):
     # this is a line
     if isinstance(arr[0], list) and isinstance(arr[0][0], float):
-        return simplify(arr, percent)
+        lines.append(arr)
 
     # this is an array of lines
     elif isinstance(arr[0], list):
-        results = []
         for subArr in arr:
-            result = simplifyRecursive(subArr, percent)
-            results.append(result)
-        return results
-
-# retrieve geojson features
-features = geojson['features']
-featureLen = len(features)
-print "Found %s features in %s" % (len(features), args.INPUT_FILE)
-for i, feature in enumerate(features):
-    # retrieve feature coordinates
-    coordinates = feature['geometry']['coordinates']
-    simplifiedCoordinates = simplifyRecursive(coordinates, args.SIMPLIFY_PERCENT)
-    geojson['features'][i]['geometry']['coordinates'] = simplifiedCoordinates
-    print "Simplified feature %s of %s" % (i+1, featureLen)
-
-# write new geojson
-filename = args.OUTPUT_FILE % args.SIMPLIFY_PERCENT
-with open(filename, 'w') as f:
-    json.dump(geojson, f)
+            flattenRecursive(subArr, lines)
+
+# rebuild arr, replacing each of its lines with the next simplified line
+def unflattenRecursive(arr, lines):
+    # this is a line
+    if isinstance(arr[0], list) and isinstance(arr[0][0], float):
+        return next(lines)
+
+    # this is an array of lines
+    elif isinstance(arr[0], list):
+        return [unflattenRecursive(subArr, lines) for subArr in arr]
+
+# points of a list of lines back to back, and the offset where each line starts
+def concatLines(lines):
+    lineLens = [len(line) for line in lines]
+    offsets = np.concatenate(([0], np.cumsum(lineLens, dtype=int)))
+    points = np.array([point for line in lines for point in line], dtype=float)
+    return (points, offsets)
+
+# lists of the lines of points back to back, split at offsets
+def splitLines(points, offsets):
+    points = points.tolist()
+    return [points[a:b] for (a, b) in zip(offsets[:-1], offsets[1:])]
+
+# the lines of a batch of features parsed from json, as the points of every line back to back
+#   and the offset where each line starts
+class FeatureLines(object):
+
+    def __init__(self, features):
+        self.featureList = features
+        self.coordinates = [feature['geometry']['coordinates'] for feature in features]
+        self.lineList = []
+        for c in self.coordinates:
+            flattenRecursive(c, self.lineList)
+        (self.points, self.offsets) = concatLines(self.lineList)
+
+    def __len__(self):
+        return len(self.featureList)
+
+    # the features, to write simplified coordinates into
+    def features(self, coordinates=False):
+        return self.featureList
+
+    # every line as a list
+    def lines(self):
+        return self.lineList
+
+    # coordinates of every feature, from a list per line
+    def nest(self, lines):
+        lines = iter(lines)
+        return [unflattenRecursive(c, lines) for c in self.coordinates]
+
+# the lines of features start to end of the geometry cache, read straight from its memory map;
+#   lists are only made for what is written
+class TableLines(object):
+
+    def __init__(self, table, start, end):
+        (self.table, self.start, self.end) = (table, start, end)
+        (self.points, self.offsets) = table.lines(start, end)
+        self.featureList = None
+
+    def __len__(self):
+        return self.end - self.start
+
+    # the features, with their coordinates only if asked for (they are overwritten when written)
+    def features(self, coordinates=False):
+        if coordinates:
+            return self.table.features(self.start, self.end)
+        if self.featureList is None:
+            self.featureList = self.table.features(self.start, self.end, coordinates=False)
+        return self.featureList
+
+    def lines(self):
+        return splitLines(self.points, self.offsets)
+
+    def nest(self, lines):
+        return self.table.nest(self.start, self.end, lines)
+
+# points of lines back to back (split at offsets) rounded to precision decimal places, dropping
+#   each point that rounds to the same place as the one before it; a line that would be left with
+#   a single point, or a ring (first point same as last) with fewer than 4, keeps all of its
+#   points. A kept point takes the highest threshold of the points dropped after it, so it stays
+#   in for as long as any of them would have
+def quantizeLines(points, offsets, precision, thresholds=None):
+    lengths = np.diff(offsets)
+    closed = np.zeros(len(lengths), dtype=bool)
+    closed[lengths > 0] = (points[offsets[:-1][lengths > 0]] == points[offsets[1:][lengths > 0] - 1]).all(axis=1)
+    minLengths = np.minimum(np.where(closed, 4, 2), lengths)
+    points = np.round(points, precision)
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = (points[1:] != points[:-1]).any(axis=1)
+    keep[offsets[:-1][lengths > 0]] = True
+    keptLengths = np.diff(np.concatenate(([0], np.cumsum(keep)))[offsets])
+    keep |= np.repeat(keptLengths < minLengths, lengths)
+    keptOffsets = np.concatenate(([0], np.cumsum(keep)))[offsets]
+    if thresholds is not None and len(points):
+        thresholds = np.maximum.reduceat(thresholds, np.flatnonzero(keep))
+    return (points[keep], keptOffsets, thresholds)
+
+# lists of lines rounded by quantizeLines, and the thresholds of their points as lists with
+#   endpoints (always kept) as null, if given
+def quantizeLineLists(lines, lineThresholds=None):
+    if not lines:
+        return (lines, lineThresholds)
+    (points, offsets) = concatLines(lines)
+    thresholds = None
+    if lineThresholds is not None:
+        thresholds = np.array([t for line in lineThresholds for t in line], dtype=float)
+        thresholds[np.isnan(thresholds)] = np.inf
+    (points, offsets, thresholds) = quantizeLines(points, offsets, PRECISION, thresholds)
+    lines = splitLines(points, offsets)
+    if thresholds is not None:
+        thresholds = np.where(np.isinf(thresholds), None, thresholds).tolist()
+        lineThresholds = [thresholds[a:b] for (a, b) in zip(offsets[:-1], offsets[1:])]
+    return (lines, lineThresholds)
+
+# build the thresholds of every point of lines back to back (split at offsets) all at once
+def buildThresholds(points, offsets):
+    if len(offsets) < 2:
+        return np.zeros((0,))
+    if args.ALGORITHM == "dp":
+        return DPBatchSimplifier(metricPoints(points, offsets), offsets).thresholds
+    return VWBatchSimplifier(points, offsets).thresholds
+
+# build thresholds for a chunk of lines in a worker process
+def buildChunkThresholds(chunk):
+    start = time.time()
+    thresholds = buildThresholds(*chunk)
+    return (thresholds, os.getpid(), time.time() - start, len(thresholds))
+
+# split lines (points back to back, split at offsets) into contiguous chunks of roughly equal
+#   point counts, each as its points and offsets
+def chunkLines(points, offsets, count):
+    target = 1.0 * offsets[-1] / count
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(offsets[:-1], np.arange(1, count) * target), [len(offsets) - 1])))
+    return [(np.asarray(points[offsets[a]:offsets[b]]), offsets[a:b+1] - offsets[a]) for (a, b) in zip(bounds[:-1], bounds[1:])]
+
+# build thresholds across the pool of worker processes, keeping their order
+def buildThresholdsParallel(points, offsets):
+    global pool, workers
+    # a few chunks per worker so one dense chunk doesn't hold up the rest
+    chunks = chunkLines(points, offsets, args.JOBS * 4)
+    results = pool.map(buildChunkThresholds, chunks, 1)
+    for (thresholds, pid, seconds, points) in results:
+        worker = workers.setdefault(pid, [0, 0, 0.0])
+        worker[0] += 1
+        worker[1] += points
+        worker[2] += seconds
+    return np.concatenate([result[0] for result in results])
+
+# simplify lines (points back to back, split at offsets) from the thresholds of their points, to
+#   a percent of each line, to a budget of points over all of them or to a tolerance (in the units
+#   of the thresholds); returns the kept points back to back and the offset where each line starts
+def simplifyLines(points, offsets, thresholds, percent, minPoints=None, budget=None, tolerance=None):
+    global MIN_POINTS
+    if len(offsets) < 2:
+        return (np.zeros((0, 2)), np.zeros(1, dtype=int))
+    simplifier = VWBatchSimplifier(None, offsets, thresholds)
+    lineLens = np.diff(offsets).tolist()
+    minPoints = minPoints or [MIN_POINTS] * len(lineLens)
+    if budget is not None:
+        # one threshold for every line, so the least significant points anywhere go first
+        minLens = [min([minLen, lineLen]) for (lineLen, minLen) in zip(lineLens, minPoints)]
+        threshold = simplifier.threshold_from_budget(budget, minLens)
+        mask = simplifier.mask_from_budget(budget, minLens)
+        print "Kept %s of a budget of %s points, at a threshold of %g for all lines" % (mask.sum(), budget, threshold)
+    elif tolerance is not None:
+        # lines too small to keep their minimum at the tolerance keep their most significant points
+        minLens = [min([minLen, lineLen]) for (lineLen, minLen) in zip(lineLens, minPoints)]
+        mask = simplifier.mask_from_threshold(tolerance) | simplifier.mask_from_number(minLens)
+    else:
+        targetLens = [max([int(round(lineLen*percent)), min([minLen, lineLen])]) for (lineLen, minLen) in zip(lineLens, minPoints)]
+        mask = simplifier.mask_from_number(targetLens)
+    # offsets of each line after masking
+    simplifiedOffsets = np.concatenate(([0], np.cumsum(mask)))[offsets]
+    return (np.asarray(points)[mask], simplifiedOffsets)
+
+# points to keep over every line (arc points in topology mode), from -vb, or from the bytes -tb
+#   leaves for coordinates once everything else in the file is written
+def vertexBudget(batch, pointCount, pointLen):
+    if args.VERTEX_BUDGET is not None:
+        budget = args.VERTEX_BUDGET
+    else:
+        # bytes of every feature at full detail, and of its coordinates alone
+        (totalBytes, coordinateBytes) = (0, 0)
+        for feature in batch.features(coordinates=True):
+            c = feature['geometry']['coordinates']
+            totalBytes += len(dumpFeature(feature, PRECISION)) + len(', ')
+            coordinateBytes += len(formatCoordinates(c, PRECISION) if PRECISION is not None else json.dumps(c))
+        pointBytes = 1.0 * coordinateBytes / max(pointCount, 1)
+        budget = pointCount - (totalBytes - args.TARGET_BYTES) / pointBytes
+        print "Estimated %.1f bytes per point, so %s of %s points fit in %s bytes" % (pointBytes, max(int(budget), 0), pointCount, args.TARGET_BYTES)
+    # arcs shared by several lines are written once for each of them
+    return max(int(budget * pointLen / max(pointCount, 1)), 0)
+
+# simplify a batch of features (FeatureLines or TableLines) at every percent (or to the budget),
+#   returns the simplified coordinates and thresholds of each feature per percent, and with
+#   PRECISION the same before rounding
+def simplifyFeatures(batch):
+    global pool, counts, cachedThresholds, builtThresholds, stages
+    (points, offsets) = (batch.points, batch.offsets)
+    lineCount = len(offsets) - 1
+    pointCount = int(offsets[-1])
+    stages.count("load", features=len(batch), verticesOut=pointCount)
+
+    # in topology mode shared boundaries are simplified once, as unique arcs
+    if args.TOPOLOGY:
+        with stages.stage("topology"):
+            (arcs, lineRefs) = buildArcs(batch.lines())
+            (points, offsets) = concatLines(arcs)
+            # only arcs that make up a whole line need MIN_POINTS; the rest keep enough not to collapse a ring
+            minPoints = [3] * len(arcs)
+            for refs in lineRefs:
+                if len(refs) == 1:
+                    minPoints[refs[0][0]] = MIN_POINTS
+        print "Split %s lines into %s unique arcs" % (lineCount, len(arcs))
+    else:
+        minPoints = None
+    pointLen = int(offsets[-1])
+
+    # thresholds come from the cache in the same order points are read
+    with stages.stage("build-thresholds"):
+        if cachedThresholds is not None:
+            thresholds = cachedThresholds[counts[3]:counts[3]+pointLen]
+        elif pool and len(offsets) > 2:
+            thresholds = buildThresholdsParallel(points, offsets)
+            builtThresholds.append(thresholds)
+        else:
+            thresholds = buildThresholds(points, offsets)
+            builtThresholds.append(thresholds)
+    stages.count("build-thresholds", verticesIn=pointLen, verticesOut=pointLen)
+    counts[0] += len(batch)
+    counts[1] += lineCount
+    counts[2] += pointCount
+    counts[3] += pointLen
+
+    results = []
+    with stages.stage("mask"):
+        verticesOut = 0
+        budget = vertexBudget(batch, pointCount, pointLen) if BUDGET_MODE else None
+        for level in LEVELS:
+            percent = None if BUDGET_MODE or TOLERANCE_MODE else level
+            (simplified, simplifiedOffsets) = simplifyLines(points, offsets, thresholds, percent, minPoints, budget, args.TOLERANCE)
+            simplifiedLines = splitLines(simplified, simplifiedOffsets)
+            if args.TOPOLOGY:
+                simplifiedLines = joinArcs(simplifiedLines, lineRefs)
+            unrounded = [None] * len(batch)
+            if PRECISION is not None:
+                # whole lines are rounded, so rings of several arcs keep enough points too
+                unrounded = [(c, None) for c in batch.nest(simplifiedLines)]
+                if args.TOPOLOGY:
+                    (simplifiedLines, _) = quantizeLineLists(simplifiedLines)
+                else:
+                    simplifiedLines = splitLines(*quantizeLines(simplified, simplifiedOffsets, PRECISION)[:2])
+            simplifiedLen = sum([len(line) for line in simplifiedLines])
+            simplifiedLens[level] += simplifiedLen
+            verticesOut += simplifiedLen
+            results.append([(c, None, u) for (c, u) in zip(batch.nest(simplifiedLines), unrounded)])
+        if args.PROGRESSIVE:
+            lineThresholds = progressiveThresholds(offsets, thresholds)
+            if args.TOPOLOGY:
+                # every line gets all of its points back, each tagged by its arc
+                lineThresholds = joinArcs(lineThresholds, lineRefs)
+                lines = joinArcs(arcs, lineRefs)
+            else:
+                lines = batch.lines()
+            unrounded = [None] * len(batch)
+            if PRECISION is not None:
+                unrounded = zip(batch.nest(lines), batch.nest(lineThresholds))
+                (lines, lineThresholds) = quantizeLineLists(lines, lineThresholds)
+            verticesOut += sum([len(line) for line in lines])
+            results.append(zip(batch.nest(lines), batch.nest(lineThresholds), unrounded))
+    # every output counts, so with several percents more vertices can come out than went in
+    stages.count("mask", verticesIn=pointCount, verticesOut=verticesOut)
+    return results
+
+# thresholds of every line (split at offsets) as lists, with endpoints (always kept) as null
+def progressiveThresholds(offsets, thresholds):
+    return splitLines(np.where(np.isinf(thresholds), None, thresholds), offsets)
+
+# set the coordinates of a feature, and the thresholds of its vertices for progressive output
+def setGeometry(feature, geometry):
+    (coordinates, thresholds) = geometry[:2]
+    feature['geometry']['coordinates'] = coordinates
+    if thresholds is None:
+        feature['geometry'].pop('thresholds', None)
+    else:
+        feature['geometry']['thresholds'] = thresholds
+
+# thresholds cached for this exact input file, if any
+def loadThresholds(filename, inputHash):
+    if not os.path.isfile(filename):
+        return None
+    cache = np.load(filename)
+    if str(cache['hash']) != inputHash:
+        print "Ignoring stale threshold cache %s" % filename
+        return None
+    print "Loaded thresholds from %s" % filename
+    return cache['thresholds']
+
+def saveThresholds(filename, inputHash, thresholds):
+    with open(filename, 'wb') as f:
+        np.savez(f, hash=inputHash, thresholds=thresholds)
+    print "Saved thresholds to %s" % filename
+
+# file-like object that only counts the bytes written to it
+class ByteCounter(object):
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, text):
+        self.bytes += len(text)
+
+# write features with their simplified geometries; with PRECISION they are also written before
+#   rounding to unroundedWriter, timed apart, so what rounding saves can be reported
+def writeFeatures(writer, unroundedWriter, features, geometries):
+    if unroundedWriter is not None:
+        with stages.stage("dump-unrounded"):
+            for (feature, geometry) in zip(features, geometries):
+                setGeometry(feature, geometry[2])
+                unroundedWriter.write(feature)
+    with stages.stage("dump"):
+        for (feature, geometry) in zip(features, geometries):
+            setGeometry(feature, geometry)
+            writer.write(feature)
+
+# close a writer and its unrounded counterpart, if any
+def closeWriters(writer, unroundedWriter, footer=[]):
+    if unroundedWriter is not None:
+        with stages.stage("dump-unrounded"):
+            unroundedWriter.close(footer)
+    with stages.stage("dump"):
+        writer.close(footer)
+
+# features, lines, points, points with thresholds (arc points in topology mode)
+counts = [0, 0, 0, 0]
+stages = Stages(args.PROFILE)
+# percent (or budget) => simplified points
+simplifiedLens = dict([(level, 0) for level in LEVELS])
+# worker pid => chunks, points, seconds
+workers = {}
+pool = Pool(args.JOBS) if args.JOBS > 1 else None
+filenames = [args.OUTPUT_FILE % level for level in LEVELS]
+if args.PROGRESSIVE:
+    filenames.append(args.OUTPUT_FILE % 'progressive')
+# bytes each output would take without rounding
+unroundedCounters = [ByteCounter() for filename in filenames] if PRECISION is not None else [None] * len(filenames)
+
+# thresholds only depend on the input, so they can be reused at any percent
+cacheFile = args.INPUT_FILE + ('.topology' if args.TOPOLOGY else '') + ('.dp' if args.ALGORITHM == "dp" else '') + '.thresholds.npz'
+inputHash = fileHash(args.INPUT_FILE) if args.CACHE else None
+cachedThresholds = loadThresholds(cacheFile, inputHash) if args.CACHE else None
+builtThresholds = []
+
+# binary copy of the input, read in place of the json
+table = None
+if args.GEOMETRY_CACHE:
+    with stages.stage("load"):
+        table = openGeometry(args.INPUT_FILE, inputHash)
+
+if args.STREAM:
+    # read, simplify and write a batch of features at a time
+    outputs = [open(filename, 'w') for filename in filenames]
+    with open(args.INPUT_FILE) as f:
+        reader = table if table is not None else FeatureReader(f)
+        writers = None
+        batch = []
+        newWriters = lambda: [(FeatureWriter(g, reader.header, PRECISION), FeatureWriter(counter, reader.header) if counter else None) for (g, counter) in zip(outputs, unroundedCounters)]
+        # simplify and write the features in batch (FeatureLines or TableLines) at every percent
+        def flush(batch):
+            results = simplifyFeatures(batch)
+            with stages.stage("load"):
+                features = batch.features()
+            for ((writer, unroundedWriter), geometries) in zip(writers, results):
+                writeFeatures(writer, unroundedWriter, features, geometries)
+        if table is not None:
+            # batches are read straight from the memory map
+            writers = newWriters()
+            for start in range(0, len(table), args.BATCH_SIZE):
+                end = min(start + args.BATCH_SIZE, len(table))
+                with stages.stage("load"):
+                    batch = TableLines(table, start, end)
+                flush(batch)
+                if end < len(table):
+                    print "Simplified %s features" % counts[0]
+        else:
+            for feature in stages.iterate("load", reader):
+                writers = writers or newWriters()
+                batch.append(feature)
+                if len(batch) >= args.BATCH_SIZE:
+                    with stages.stage("load"):
+                        batch = FeatureLines(batch)
+                    flush(batch)
+                    batch = []
+                    print "Simplified %s features" % counts[0]
+            writers = writers or newWriters()
+            with stages.stage("load"):
+                batch = FeatureLines(batch)
+            flush(batch)
+        for (writer, unroundedWriter) in writers:
+            closeWriters(writer, unroundedWriter, reader.footer)
+    with stages.stage("dump"):
+        for g in outputs:
+            g.close()
+    print "Streamed %s features from %s" % (counts[0], args.INPUT_FILE)
+
+else:
+    # read geojson file, and the lines of its features
+    geojson = {}
+    with stages.stage("load"):
+        if table is not None:
+            # lines come straight from the memory map, and features are only built to be written
+            geojson = dict(table.header + [('features', None)] + table.footer)
+            batch = TableLines(table, 0, len(table))
+        else:
+            with open(args.INPUT_FILE) as f:
+                geojson = json.load(f)
+            batch = FeatureLines(geojson['features'])
+    print "Found %s features in %s" % (len(batch), args.INPUT_FILE)
+
+    # write new geojson at every percent
+    header = [(key, value) for (key, value) in geojson.items() if key != 'features']
+    results = simplifyFeatures(batch)
+    with stages.stage("load"):
+        features = batch.features()
+    for (filename, counter, geometries) in zip(filenames, unroundedCounters, results):
+        with open(filename, 'w') as f:
+            writer = FeatureWriter(f, header, PRECISION)
+            unroundedWriter = FeatureWriter(counter, header) if counter else None
+            writeFeatures(writer, unroundedWriter, features, geometries)
+            closeWriters(writer, unroundedWriter)
+
+if pool:
+    pool.close()
+    pool.join()
+    for pid in sorted(workers):
+        (chunkCount, points, seconds) = workers[pid]
+        print "Worker %s built thresholds for %s chunks (%s points) in %.3fs" % (pid, chunkCount, points, seconds)
+if args.CACHE and cachedThresholds is None:
+    saveThresholds(cacheFile, inputHash, np.concatenate(builtThresholds))
+# size of a written file, and what it would have been without rounding
+def sizeText(filename, counter):
+    return "%s bytes%s" % (os.path.getsize(filename), ", %s unrounded" % counter.bytes if counter else "")
+for (filename, counter, level) in zip(filenames, unroundedCounters, LEVELS):
+    print "Simplified %s lines in %s features to %s (%s of %s points kept, %s)" % (counts[1], counts[0], filename, simplifiedLens[level], counts[2], sizeText(filename, counter))
+if args.PROGRESSIVE:
+    print "Wrote thresholds of %s points in %s features to %s (%s)" % (counts[2], counts[0], filenames[-1], sizeText(filenames[-1], unroundedCounters[-1]))
+stages.count("dump", bytes=sum([os.path.getsize(filename) for filename in filenames]))
+if PRECISION is not None:
+    stages.count("dump-unrounded", bytes=sum([counter.bytes for counter in unroundedCounters]))
+    print "Wrote %s bytes in %.3fs at %s decimal places, from %s bytes in %.3fs unrounded" % (stages.get("dump")["bytes"], stages.get("dump")["seconds"], PRECISION, stages.get("dump-unrounded")["bytes"], stages.get("dump-unrounded")["seconds"])
+else:
+    print "Wrote %s bytes in %.3fs" % (stages.get("dump")["bytes"], stages.get("dump")["seconds"])
+if args.STATS_FILE or args.PROFILE:
+    stages.save(args.STATS_FILE or 'simplifygeojson_stages.json')
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# Description: uniform grid index over bounding boxes; every box is listed under each
+#   cell it touches, so a query only looks at the cells around it and its cost depends
+#   on how many boxes are nearby rather than on how many there are in total
+# Example usage:
+#   index = GridIndex(boxes, cellSize)
+#   ids = index.query([minX, minY, maxX, maxY])
+#   (snapped, distances) = snapToSegments(points, allowed, starts, ends, segmentGroups, cellSize)
+#   corners = convexHull(points)
+#   meters = metricPoints(lnglats, offsets)
+
+import numpy as np
+
+# meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+# lng/lat points of lines back to back (split at offsets) in meters, with a degree of lng as long
+#   as it is at the mean latitude of its line; per line, so it doesn't depend on how lines are batched
+def metricPoints(points, offsets):
+    lengths = np.diff(offsets)
+    starts = offsets[:-1][lengths > 0]
+    latitudes = np.add.reduceat(points[:, 1], starts) / lengths[lengths > 0]
+    scale = np.ones(points.shape)
+    scale[:, 0] = np.repeat(np.cos(np.radians(latitudes)), lengths[lengths > 0])
+    return points * scale * METERS_PER_DEGREE
+
+# [minX, minY, maxX, maxY] of every path in an (N,2) point array split at offsets
+def pathBoxes(points, offsets):
+    starts = offsets[:-1]
+    if not len(starts):
+        return np.zeros((0, 4))
+    mins = np.minimum.reduceat(points, starts)
+    maxs = np.maximum.reduceat(points, starts)
+    return np.hstack((mins, maxs))
+
+class GridIndex(object):
+
+    def __init__(self, boxes, cellSize):
+        self.boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        self.cellSize = float(cellSize)
+        count = len(self.boxes)
+        self.origin = self.boxes[:, :2].min(axis=0) if count else np.zeros(2)
+        # cell range of every box
+        (x0, y0) = self.cells(self.boxes[:, :2]).T
+        (x1, y1) = self.cells(self.boxes[:, 2:]).T
+        self.cols = int(x1.max()) + 1 if count else 1
+        self.rows = int(y1.max()) + 1 if count else 1
+        # one (cell, box) pair for every cell a box touches
+        w = x1 - x0 + 1
+        sizes = w * (y1 - y0 + 1)
+        ids = np.repeat(np.arange(count), sizes)
+        k = np.arange(len(ids)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        pairCells = (y0[ids] + k // w[ids]) * self.cols + x0[ids] + k % w[ids]
+        # boxes sorted by cell, with where each cell starts
+        order = np.argsort(pairCells, kind='mergesort')
+        self.items = ids[order]
+        self.cellStarts = np.searchsorted(pairCells[order], np.arange(self.cols * self.rows + 1))
+
+    # column and row of each (N,2) point
+    def cells(self, points):
+        return np.floor((points - self.origin) / self.cellSize).astype(int)
+
+    # ids of boxes intersecting box, in ascending order
+    def query(self, box):
+        (x0, y0) = np.maximum(self.cells(np.array(box[:2], dtype=float)), 0)
+        (x1, y1) = np.minimum(self.cells(np.array(box[2:], dtype=float)), [self.cols - 1, self.rows - 1])
+        if x0 > x1 or y0 > y1:
+            return np.zeros((0,), dtype=int)
+        rows = np.arange(y0, y1 + 1) * self.cols
+        starts = self.cellStarts[rows + x0]
+        ends = self.cellStarts[rows + x1 + 1]
+        ids = np.unique(np.concatenate([self.items[a:b] for (a, b) in zip(starts, ends)]))
+        # cells are coarse, so check the boxes themselves
+        boxes = self.boxes[ids]
+        hits = (boxes[:, 0] <= box[2]) & (boxes[:, 2] >= box[0]) & (boxes[:, 1] <= box[3]) & (boxes[:, 3] >= box[1])
+        return ids[hits]
+
+# corners of the convex hull of an (N,2) point array, counterclockwise, by Andrew's monotone
+#   chain; an affine map of the points reaches its extremes at these corners
+def convexHull(points):
+    points = sorted(set(map(tuple, np.asarray(points, dtype=float).tolist())))
+    if len(points) <= 2:
+        return np.array(points, dtype=float).reshape(-1, 2)
+    chains = []
+    for ordered in [points, points[::-1]]:
+        chain = []
+        for (x, y) in ordered:
+            # drop corners that don't turn left
+            while len(chain) >= 2 and (chain[-1][0] - chain[-2][0]) * (y - chain[-2][1]) - (chain[-1][1] - chain[-2][1]) * (x - chain[-2][0]) <= 0:
+                chain.pop()
+            chain.append((x, y))
+        chains.append(chain[:-1])
+    return np.array(chains[0] + chains[1])
+
+# distance from every point to the segment paired with it, and the nearest point on that segment
+def pointSegmentDistances(points, starts, ends):
+    d = ends - starts
+    lengths = (d * d).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = ((points - starts) * d).sum(axis=1) / lengths
+    # a segment of zero length is nearest at its start
+    t = np.clip(np.where(lengths > 0, t, 0.0), 0.0, 1.0)
+    nearest = starts + t[:, None] * d
+    return (np.hypot(*(points - nearest).T), nearest)
+
+# move every point onto the nearest segment from starts to ends whose group is in its allowed
+#   set; looks in a growing box around each point, starting at radius. Returns the snapped
+#   points and how far each moved, inf (and left where it was) where no segment is allowed
+def snapToSegments(points, allowed, starts, ends, segmentGroups, radius):
+    points = np.asarray(points, dtype=float)
+    snapped = points.copy()
+    distances = np.full(len(points), np.inf)
+    index = GridIndex(np.hstack((np.minimum(starts, ends), np.maximum(starts, ends))), radius)
+    # past this, the box already covers every segment
+    maxRadius = max(np.ptp(np.vstack((starts, ends, points)), axis=0).max(), radius) if len(starts) else 0
+    for (i, point) in enumerate(points):
+        groups = np.array(sorted(allowed[i]), dtype=int)
+        if not len(groups):
+            continue
+        r = radius
+        while r <= 2 * maxRadius:
+            ids = index.query([point[0] - r, point[1] - r, point[0] + r, point[1] + r])
+            ids = ids[np.in1d(segmentGroups[ids], groups)]
+            if len(ids):
+                (d, nearest) = pointSegmentDistances(point[None, :], starts[ids], ends[ids])
+                best = np.argmin(d)
+                # anything nearer would have been inside the box
+                if d[best] <= r:
+                    snapped[i] = nearest[best]
+                    distances[i] = d[best]
+                    break
+            r *= 2
+    return (snapped, distances)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Description: writes the svg drawn by geojson2svg.py; SVGStreamWriter writes each element
+#   to the file as soon as it is drawn, SVGDrawingWriter builds an svgwrite drawing and
+#   saves it at the end. Both write the same bytes.
+# Example usage:
+#   svg = SVGStreamWriter("data/nyc.svg", width, height)
+#   svg.startGroup("background")
+#   svg.rect("#A2CAEA")
+#   svg.endGroup()
+#   svg.close()
+
+from cStringIO import StringIO
+import numpy as np
+
+BUFFER_SIZE = 1 << 20
+
+# escape an attribute value the way svgwrite (ElementTree) does
+def escapeAttr(value):
+    value = '%s' % value
+    if "&" in value:
+        value = value.replace("&", "&amp;")
+    if "<" in value:
+        value = value.replace("<", "&lt;")
+    if ">" in value:
+        value = value.replace(">", "&gt;")
+    if "\"" in value:
+        value = value.replace("\"", "&quot;")
+    if "\n" in value:
+        value = value.replace("\n", "&#10;")
+    return value.encode('utf-8', 'xmlcharrefreplace') if isinstance(value, unicode) else value
+
+# list of (x, y) points to 'x,y x,y ...'
+def pointsToString(points):
+    return ' '.join(['%s,%s' % (x, y) for (x, y) in points])
+
+# whole numbers separated by spaces, or just by the minus sign where there is one
+def numbersToString(numbers):
+    return ' '.join(map(str, numbers)).replace(' -', '-')
+
+# path data for (N,2) integer point arrays, each a subpath made of a relative move followed
+#   by implicit relative lines, closed if closed; steps of zero are left out
+def pathData(paths, closed):
+    pen = np.zeros(2, dtype=int)
+    commands = []
+    for points in paths:
+        # the close command brings the pen back to the start
+        if closed and len(points) > 1 and np.array_equal(points[0], points[-1]):
+            points = points[:-1]
+        steps = np.diff(points, axis=0)
+        steps = steps[np.any(steps != 0, axis=1)]
+        commands.append('m' + numbersToString([points[0][0] - pen[0], points[0][1] - pen[1]] + steps.ravel().tolist()))
+        if closed:
+            commands.append('z')
+            pen = points[0]
+        else:
+            pen = points[-1]
+    return ''.join(commands)
+
+def polygonMarkup(points, fill):
+    return '<polygon fill="%s" points="%s" />' % (escapeAttr(fill), pointsToString(points))
+
+def polylineMarkup(points, stroke, strokeWidth):
+    return '<polyline fill="none" points="%s" stroke="%s" stroke-width="%s" />' % (pointsToString(points), escapeAttr(stroke), escapeAttr(strokeWidth))
+
+def circleMarkup(center, r, fill):
+    return '<circle cx="%s" cy="%s" fill="%s" r="%s" />' % (center[0], center[1], escapeAttr(fill), escapeAttr(r))
+
+def pathMarkup(d, fill, stroke=None, strokeWidth=None):
+    if stroke is None:
+        return '<path d="%s" fill="%s" />' % (d, escapeAttr(fill))
+    return '<path d="%s" fill="%s" stroke="%s" stroke-width="%s" />' % (d, escapeAttr(fill), escapeAttr(stroke), escapeAttr(strokeWidth))
+
+class SVGStreamWriter(object):
+
+    def __init__(self, filename, width, height):
+        self.f = open(filename, 'w', BUFFER_SIZE)
+        self.width = width
+        self.height = height
+        # open groups as [id, written], written once they have something in them
+        self.groups = []
+        self.f.write('<?xml version="1.0" encoding="utf-8" ?>\n')
+        self.f.write('<svg baseProfile="full" height="%spx" version="1.1" width="%spx" xmlns="http://www.w3.org/2000/svg" xmlns:ev="http://www.w3.org/2001/xml-events" xmlns:xlink="http://www.w3.org/1999/xlink"><defs />' % (height, width))
+
+    # write the start tags of groups that are still pending
+    def openGroups(self):
+        for group in self.groups:
+            if not group[1]:
+                self.f.write('<g id="%s">' % escapeAttr(group[0]))
+                group[1] = True
+
+    def startGroup(self, groupId):
+        self.groups.append([groupId, False])
+
+    def endGroup(self):
+        (groupId, written) = self.groups.pop()
+        if written:
+            self.f.write('</g>')
+        else:
+            # empty groups are self-closing
+            self.openGroups()
+            self.f.write('<g id="%s" />' % escapeAttr(groupId))
+
+    def rect(self, fill):
+        self.openGroups()
+        self.f.write('<rect fill="%s" height="%spx" width="%spx" x="0" y="0" />' % (escapeAttr(fill), self.height, self.width))
+
+    def polygon(self, points, fill):
+        self.openGroups()
+        self.f.write(polygonMarkup(points, fill))
+
+    def polyline(self, points, stroke, strokeWidth):
+        self.openGroups()
+        self.f.write(polylineMarkup(points, stroke, strokeWidth))
+
+    def circle(self, center, r, fill):
+        self.openGroups()
+        self.f.write(circleMarkup(center, r, fill))
+
+    def path(self, d, fill, stroke=None, strokeWidth=None):
+        self.openGroups()
+        self.f.write(pathMarkup(d, fill, stroke, strokeWidth))
+
+    # elements written before, such as a group kept by startCapture/endCapture
+    def markup(self, markup):
+        self.openGroups()
+        self.f.write(markup)
+
+    # from here on, keep what is written as well as writing it, until endCapture returns it
+    def startCapture(self):
+        self.openGroups()
+        self.captured = self.f
+        self.f = StringIO()
+
+    def endCapture(self):
+        markup = self.f.getvalue()
+        self.f = self.captured
+        self.f.write(markup)
+        return markup
+
+    def close(self):
+        self.f.write('</svg>')
+        self.f.close()
+
+class SVGDrawingWriter(object):
+
+    def __init__(self, filename, width, height):
+        import svgwrite
+        from svgwrite import px
+        self.width = width * px
+        self.height = height * px
+        self.dwg = svgwrite.Drawing(filename, size=(self.width, self.height), profile='full')
+        self.groups = [self.dwg]
+
+    def startGroup(self, groupId):
+        self.groups.append(self.groups[-1].add(self.dwg.g(id=groupId)))
+
+    def endGroup(self):
+        self.groups.pop()
+
+    def rect(self, fill):
+        self.groups[-1].add(self.dwg.rect(size=(self.width, self.height), fill=fill))
+
+    def polygon(self, points, fill):
+        self.groups[-1].add(self.dwg.polygon(points=points, fill=fill))
+
+    def polyline(self, points, stroke, strokeWidth):
+        self.groups[-1].add(self.dwg.polyline(points=points, stroke=stroke, stroke_width=strokeWidth, fill="none"))
+
+    def circle(self, center, r, fill):
+        self.groups[-1].add(self.dwg.circle(center=center, r=r, fill=fill))
+
+    def path(self, d, fill, stroke=None, strokeWidth=None):
+        if stroke is None:
+            self.groups[-1].add(self.dwg.path(d=d, fill=fill))
+        else:
+            self.groups[-1].add(self.dwg.path(d=d, fill=fill, stroke=stroke, stroke_width=strokeWidth))
+
+    def close(self):
+        self.dwg.save()
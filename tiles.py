@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+# Description: cuts the projected paths drawn by geojson2svg.py into a z/x/y pyramid of
+#   square svg tiles; each tile looks up the paths around it in a GridIndex, clips them to
+#   its edges and is written on its own, so tiles can be rendered across worker processes
+# Example usage:
+#   state = TileState("data/tiles", 256, worldSize, points, offsets, areas, drawOrder, ...)
+#   renderTiles(state, tileRange([0, 1, 2], state, width, height), 4)
+
+from multiprocessing import Pool
+import numpy as np
+import os
+from spatialindex import GridIndex, pathBoxes
+from svgwriter import SVGStreamWriter
+
+# px drawn around each tile so strokes crossing its edge aren't cut short
+TILE_BUFFER = 8
+# a path clipped to a tile is drawn if it has more points than this (lines need more than 1)
+MIN_PIECE_POINTS = {"polygon": 3, "point": 0}
+
+# keep the part of a ring (without its closing point) on the side of axis=value given by sign
+def clipRingEdge(points, axis, value, sign):
+    d = (points[:, axis] - value) * sign
+    inside = d >= 0
+    if inside.all() or not inside.any():
+        return points if inside.all() else points[:0]
+    nextPoints = np.roll(points, -1, axis=0)
+    nextD = np.roll(d, -1)
+    crossing = inside != np.roll(inside, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(crossing, d / (d - nextD), 0.0)
+    crossings = points + t[:, None] * (nextPoints - points)
+    # each point if it is inside, followed by where its edge crosses the line
+    return np.stack((points, crossings), axis=1)[np.stack((inside, crossing), axis=1)]
+
+# clip a closed ring to [minX, minY, maxX, maxY] (Sutherland-Hodgman); returns a closed ring,
+#   empty if nothing is left
+def clipPolygon(points, box):
+    ring = points[:-1] if len(points) > 1 and np.array_equal(points[0], points[-1]) else points
+    for (axis, value, sign) in ((0, box[0], 1), (0, box[2], -1), (1, box[1], 1), (1, box[3], -1)):
+        ring = clipRingEdge(ring, axis, value, sign)
+        if not len(ring):
+            return ring
+    return np.vstack((ring, ring[:1]))
+
+# clip a line to [minX, minY, maxX, maxY] (Liang-Barsky on every segment at once); returns
+#   the list of pieces left inside
+def clipPolyline(points, box):
+    p0 = points[:-1]
+    dp = points[1:] - p0
+    t0 = np.zeros(len(dp))
+    t1 = np.ones(len(dp))
+    valid = np.ones(len(dp), dtype=bool)
+    for (axis, lo, hi) in ((0, box[0], box[2]), (1, box[1], box[3])):
+        s = p0[:, axis]
+        d = dp[:, axis]
+        flat = d == 0
+        valid &= ~flat | ((s >= lo) & (s <= hi))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ta = (lo - s) / d
+            tb = (hi - s) / d
+        t0 = np.maximum(t0, np.where(flat, 0.0, np.minimum(ta, tb)))
+        t1 = np.minimum(t1, np.where(flat, 1.0, np.maximum(ta, tb)))
+    valid &= t0 <= t1
+    if not valid.any():
+        return []
+    a = p0 + t0[:, None] * dp
+    b = p0 + t1[:, None] * dp
+    # a piece starts where the line comes back in, or after a segment that left
+    prevValid = np.concatenate(([False], valid[:-1]))
+    prevT1 = np.concatenate(([0.0], t1[:-1]))
+    starts = valid & (~prevValid | (prevT1 < 1) | (t0 > 0))
+    # the start of every piece, followed by the end of each of its segments
+    keep = np.stack((starts, valid), axis=1).ravel()
+    points = np.stack((a, b), axis=1).reshape(-1, 2)[keep]
+    positions = (np.cumsum(keep) - keep)[0::2][starts]
+    return np.split(points, positions[1:])
+
+# round tile coordinates to whole px, dropping points that land on the one before
+def roundPath(points):
+    points = np.round(points).astype(int)
+    repeated = np.concatenate(([False], np.all(points[1:] == points[:-1], axis=1)))
+    return points[~repeated]
+
+class TileState(object):
+
+    # everything a worker needs to draw any tile: points are projected (unrounded) px at
+    #   zoom 0 where the map fits in one world of worldSize px, areas are their polygon areas,
+    #   drawOrder lists visible paths in paint order
+    def __init__(self, directory, tileSize, worldSize, points, offsets, areas, drawOrder, pathGroups, pathStyles, store, bgColor, minArea, maxZoom):
+        self.directory = directory
+        self.tileSize = tileSize
+        self.worldSize = float(worldSize)
+        self.points = points
+        self.offsets = offsets
+        self.areas = areas
+        self.pathGroups = pathGroups
+        self.pathStyles = pathStyles
+        self.styles = store.styles
+        self.groups = store.groups
+        self.layers = store.layers
+        self.groupLayers = store.groupLayers
+        self.bgColor = bgColor
+        self.minArea = minArea
+        self.isPolygon = np.array([draw=="polygon" for (color, draw, strokeWidth) in store.styles])[pathStyles]
+        # paint rank of every path; paths that aren't drawn are left out of the index
+        self.rank = np.full(len(offsets) - 1, -1, dtype=int)
+        self.rank[drawOrder] = np.arange(len(drawOrder))
+        self.boxes = pathBoxes(points, offsets)
+        self.ids = np.asarray(drawOrder, dtype=int)
+        # cells the size of the smallest tiles
+        self.index = GridIndex(self.boxes[self.ids], self.worldSize / (1 << maxZoom))
+
+    # px at zoom z for one px at zoom 0
+    def scale(self, z):
+        return float(self.tileSize * (1 << z)) / self.worldSize
+
+# tile state shared with worker processes, which get a copy when the pool forks
+tileState = None
+
+def setTileState(state):
+    global tileState
+    tileState = state
+
+# (z, x, y) of every tile covering the map at each zoom
+def tileRange(zooms, state, width, height):
+    tiles = []
+    for z in zooms:
+        n = 1 << z
+        cols = min(n, int(np.ceil(width * n / state.worldSize)))
+        rows = min(n, int(np.ceil(height * n / state.worldSize)))
+        tiles += [(z, x, y) for x in range(cols) for y in range(rows)]
+    return tiles
+
+# draw one tile; returns (z, x, y, paths drawn)
+def renderTile(tile):
+    (z, x, y) = tile
+    state = tileState
+    size = state.worldSize / (1 << z)
+    scale = state.scale(z)
+    origin = np.array([x * size, y * size])
+    buf = TILE_BUFFER / scale
+    box = [origin[0] - buf, origin[1] - buf, origin[0] + size + buf, origin[1] + size + buf]
+
+    # paths near the tile that are big enough to see at this zoom, in paint order
+    ids = state.ids[state.index.query(box)]
+    ids = ids[~state.isPolygon[ids] | (state.areas[ids] * scale * scale > state.minArea)]
+    ids = ids[np.argsort(state.rank[ids])]
+
+    directory = os.path.join(state.directory, str(z), str(x))
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # made by another worker in the meantime
+            pass
+    svg = SVGStreamWriter(os.path.join(directory, '%s.svg' % y), state.tileSize, state.tileSize)
+    svg.startGroup('background')
+    svg.rect(state.bgColor)
+    svg.endGroup()
+
+    drawn = 0
+    (layer, group) = (None, None)
+    for i in ids:
+        points = state.points[state.offsets[i]:state.offsets[i+1]]
+        inside = state.boxes[i, 0] >= box[0] and state.boxes[i, 1] >= box[1] and state.boxes[i, 2] <= box[2] and state.boxes[i, 3] <= box[3]
+        (color, draw, strokeWidth) = state.styles[state.pathStyles[i]]
+        if draw=="polygon":
+            pieces = [points if inside else clipPolygon(points, box)]
+        else:
+            pieces = [points] if inside else clipPolyline(points, box)
+        pieces = [roundPath((piece - origin) * scale) for piece in pieces if len(piece)]
+        pieces = [piece for piece in pieces if len(piece) > MIN_PIECE_POINTS.get(draw, 1)]
+        if not pieces:
+            continue
+        # open the groups of this path, only once they have something in them
+        groupCode = state.pathGroups[i]
+        if groupCode != group:
+            if group is not None:
+                svg.endGroup()
+            if state.groupLayers[groupCode] != layer:
+                if layer is not None:
+                    svg.endGroup()
+                layer = state.groupLayers[groupCode]
+                svg.startGroup(state.layers[layer])
+            group = groupCode
+            svg.startGroup(state.groups[group]["id"])
+        for piece in pieces:
+            if draw=="polygon":
+                svg.polygon(piece.tolist(), color)
+            elif draw=="point":
+                svg.circle(piece[0].tolist(), strokeWidth, color)
+            else:
+                svg.polyline(piece.tolist(), color, strokeWidth)
+        drawn += 1
+    if group is not None:
+        svg.endGroup()
+        svg.endGroup()
+    svg.close()
+    return (z, x, y, drawn)
+
+# render tiles across jobs worker processes
+def renderTiles(state, tiles, jobs):
+    setTileState(state)
+    if jobs <= 1:
+        return [renderTile(tile) for tile in tiles]
+    pool = Pool(jobs)
+    try:
+        # small chunks keep workers busy, as dense tiles take longer than empty ones
+        return pool.map(renderTile, tiles, 4)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Description: splits lines and rings into shared arcs, so a boundary shared by
+#   several features can be simplified once and every feature gets the same result
+# Example usage:
+#   (arcs, lineRefs) = buildArcs(lines)
+#   simplifiedArcs = [simplify(arc) for arc in arcs]
+#   simplifiedLines = joinArcs(simplifiedArcs, lineRefs)
+
+# a ring ends where it starts
+def isClosed(line):
+    return len(line) >= 4 and line[0] == line[-1]
+
+# points where lines meet or part ways: endpoints of open lines, and points
+#   seen with different neighbors in different places
+def findJunctions(lines):
+    neighbors = {}
+    junctions = set()
+    for line in lines:
+        points = [tuple(point) for point in line]
+        if isClosed(line):
+            points = points[:-1]
+            count = len(points)
+            pairs = [(points[i-1], points[(i+1) % count]) for i in range(count)]
+        else:
+            junctions.add(points[0])
+            junctions.add(points[-1])
+            pairs = zip(points[:-2], points[2:])
+            points = points[1:-1]
+        for (point, (a, b)) in zip(points, pairs):
+            pair = (a, b) if a <= b else (b, a)
+            seen = neighbors.setdefault(point, pair)
+            if seen != pair:
+                junctions.add(point)
+    return junctions
+
+# cut a line at its junctions into arcs that share their endpoints
+def cutLine(line, junctions):
+    if isClosed(line):
+        count = len(line) - 1
+        cuts = [i for i in range(count) if tuple(line[i]) in junctions]
+        if not cuts:
+            return [line]
+        # start the ring at its first junction so no arc wraps around
+        start = cuts[0]
+        line = line[start:count] + line[:start] + [line[start]]
+        cuts = [i - start for i in cuts] + [count]
+    else:
+        cuts = [0] + [i for i in range(1, len(line)-1) if tuple(line[i]) in junctions] + [len(line)-1]
+    return [line[a:b+1] for (a, b) in zip(cuts[:-1], cuts[1:])]
+
+# split lines into unique arcs; returns the arcs and, for every line, the list of
+#   (arc index, reversed) it is made of
+def buildArcs(lines):
+    junctions = findJunctions(lines)
+    arcs = []
+    index = {}
+    lineRefs = []
+    for line in lines:
+        refs = []
+        for arc in cutLine(line, junctions):
+            key = tuple([tuple(point) for point in arc])
+            if key in index:
+                refs.append((index[key], False))
+            elif key[::-1] in index:
+                refs.append((index[key[::-1]], True))
+            else:
+                index[key] = len(arcs)
+                refs.append((len(arcs), False))
+                arcs.append(arc)
+        lineRefs.append(refs)
+    return (arcs, lineRefs)
+
+# rebuild lines from per-arc values (points, or anything else per point),
+#   dropping the point each arc shares with the one before it
+def joinArcs(arcValues, lineRefs):
+    lines = []
+    for refs in lineRefs:
+        line = []
+        for (i, isReversed) in refs:
+            values = arcValues[i][::-1] if isReversed else arcValues[i]
+            line += values[1:] if line else values
+        lines.append(line)
+    return lines